@@ -0,0 +1,382 @@
+import os, sys, shutil
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import helpers
+import listio
+
+#-----------------------------------#
+# ----- Benchmark settings ----
+#-----------------------------------#
+
+# number of cells along each side of the synthetic (square) DISV grid
+grid_sizes = [50, 100, 200]
+
+# number of particles per well and drain (model runs only)
+part_counts = [100, 500]
+
+# number of repetitions of each timed stage (min and median are reported)
+repeat = 5
+
+# import sets timed by the import benchmark, in a new interpreter for each repeat
+# forward_run : imports of forward_run.py as written by pyemu PstFrom (see setup_pst.py)
+import_sets = {
+        'python':'pass',
+        'listio':'import listio',
+        'helpers':'import helpers',
+        'forward_run':'import os\nimport sys\nimport multiprocessing as mp\nimport numpy as np'
+            '\nimport pandas as pd\nimport pyemu\nimport helpers',
+        }
+
+# output dir for benchmark results (one json file per commit)
+bench_dir = 'bench'
+
+# river reaches, drains and wells of the synthetic model (as in setup_ml.py)
+reach_names = ['THIL_AVAL','THIL_AMONT','MOULINAT_AMONT','GAJAC','BUSSAGUET_AMONT']
+drn_names = ['BAR','GAL']
+wel_names = ['R20','R21']
+
+#-----------------------------------#
+#    synthetic model files
+#-----------------------------------#
+
+# cell ids of boundary conditions on a n x n grid (0-based node numbers)
+def get_bc_nodes(n):
+    row = n//2
+    # river along middle row, split into reaches
+    riv_nodes = np.array_split(row*n + np.arange(n//10, n), len(reach_names))
+    bc_nodes = {
+            'ghb':np.arange(n)*n, # first column
+            'riv':{name:nodes for name,nodes in zip(reach_names,riv_nodes)},
+            'drn':{name:(row+2+i)*n + np.arange(n//4, n//2)
+                for i,name in enumerate(drn_names)},
+            'wel':{name:(row-2-i)*n + n//2 for i,name in enumerate(wel_names)}
+            }
+    return(bc_nodes)
+
+# write synthetic input and output files of a worker dir with a single case (ml_01)
+# used to time pre- and post-processing without model runs
+def write_synthetic_worker(root, n):
+    ncpl = n*n
+    bc_nodes = get_bc_nodes(n)
+    case_dir = os.path.join(root,'ml_01')
+    for d in [os.path.join(root,'com_ext'), os.path.join(case_dir,'ext'),
+            os.path.join(case_dir,'sim')]:
+        os.makedirs(d)
+    rng = np.random.default_rng(0)
+
+    # common external files
+    np.savetxt(os.path.join(root,'com_ext','k.txt'),
+            np.full((1,ncpl),1e-4), fmt='%.10G')
+    np.savetxt(os.path.join(root,'com_ext','rech_spd_1.txt'), [[3e-9]], fmt='%.10G')
+    with open(os.path.join(root,'com_ext','ghb_spd_1.txt'),'w') as f:
+        for node in bc_nodes['ghb']:
+            f.write(f'1 {node+1} 22.0 1e-3 ghb\n')
+
+    # case external files
+    with open(os.path.join(case_dir,'ext','wel_spd_01_1.txt'),'w') as f:
+        for name, node in bc_nodes['wel'].items():
+            f.write(f'1 {node+1} -0.05 {name.lower()}\n')
+    with open(os.path.join(case_dir,'ext','drn_spd_01_1.txt'),'w') as f:
+        for name, nodes in bc_nodes['drn'].items():
+            for node in nodes:
+                f.write(f'1 {node+1} 8.0 1e-2 {name.lower()}\n')
+    with open(os.path.join(case_dir,'ext','riv_spd_01_1.txt'),'w') as f:
+        for fid, (name, nodes) in enumerate(bc_nodes['riv'].items()):
+            for node in nodes:
+                f.write(f'1 {node+1} 10.0 1e-2 9.0 {fid} {name.lower()}\n')
+    np.savetxt(os.path.join(case_dir,'ext','strt.txt'),
+            np.full((1,ncpl),15.), fmt='%.10G')
+
+    # template of pilot point parameters, one parameter per cell (worst case)
+    with open(os.path.join(root,'k.txt.tpl'),'w') as f:
+        f.write('ptf ~\n' + ' '.join([f'~ hk_{i} ~' for i in range(ncpl)]) + '\n')
+    with open(os.path.join(root,'par.dat'),'w') as f:
+        f.write(''.join([f'hk_{i} {v}\n' for i,v in enumerate(rng.uniform(1e-5,1e-3,ncpl))]))
+
+    # pest-free run inputs of case (see helpers.run) : templates of k and river 
+    # stage/conductance (one parameter pair per reach), parameter values, info file
+    with open(os.path.join(root,'k.txt.tpl')) as f:
+        k_tpl = f.read()
+    with open(os.path.join(case_dir,'k.txt.tpl'),'w') as f:
+        f.write(k_tpl)
+    with open(os.path.join(case_dir,'riv_spd_01_1.txt.tpl'),'w') as f:
+        f.write('ptf ~\n')
+        for fid, (name, nodes) in enumerate(bc_nodes['riv'].items()):
+            for node in nodes:
+                f.write(f'1 {node+1} ~ stage_{fid} ~ ~ cond_{fid} ~ 9.0 {fid} {name.lower()}\n')
+    shutil.copy(os.path.join(root,'par.dat'), case_dir)
+    with open(os.path.join(case_dir,'par.dat'),'a') as f:
+        for fid in range(len(bc_nodes['riv'])):
+            f.write(f'stage_{fid} 10.0\ncond_{fid} 1e-2\n')
+    pd.DataFrame({'tpl_file':['k.txt.tpl','riv_spd_01_1.txt.tpl']}).to_csv(
+            os.path.join(case_dir,'ml_info.csv'), index=False)
+
+    # outputs : heads, drain observations
+    with open(os.path.join(case_dir,'ml.hds'),'wb') as f:
+        f.write(np.array([1,1],'<i4').tobytes() + np.ones(2,'<f8').tobytes())
+        f.write('HEAD'.rjust(16).encode() + np.array([ncpl,1,1],'<i4').tobytes())
+        f.write(rng.uniform(5,20,ncpl).astype('<f8').tobytes())
+    pd.DataFrame({name:[-0.01] for name in drn_names},
+            index=pd.Index([1.0],name='time')).to_csv(os.path.join(case_dir,'sim','drn.csv'))
+
+    return(case_dir)
+
+#-----------------------------------#
+#    synthetic model (mf6 and mp7)
+#-----------------------------------#
+
+# build synthetic DISV case with the package layout of setup_ml.py
+# GHB, RCHA, WEL, DRN, RIV (with fid aux), mp7 tracking from wells and drains
+def build_synthetic_model(root, n, n_part, simulationtype='pathline'):
+    import flopy
+    import geopandas as gpd
+    from shapely.geometry import Point, LineString
+    from tracktools import ParticleGenerator
+
+    case_dir = os.path.join(root,'ml_01')
+    for d in [os.path.join(root,'com_ext'), os.path.join(case_dir,'ext'),
+            os.path.join(case_dir,'sim')]:
+        os.makedirs(d)
+    bc_nodes = get_bc_nodes(n)
+    delr = 25. # m
+
+    # regular grid as disv
+    iv = np.arange((n+1)*(n+1)).reshape(n+1,n+1)
+    vertices = [[iv[i,j], j*delr, (n-i)*delr] for i in range(n+1) for j in range(n+1)]
+    cell2d = [[i*n+j, (j+0.5)*delr, (n-i-0.5)*delr, 4,
+        iv[i,j], iv[i,j+1], iv[i+1,j+1], iv[i+1,j]] for i in range(n) for j in range(n)]
+    xc = np.array([c[1] for c in cell2d])
+    yc = np.array([c[2] for c in cell2d])
+
+    sim = flopy.mf6.MFSimulation(sim_name='mfsim', sim_ws=case_dir, exe_name='mf6')
+    sim.simulation_data.wrap_multidim_arrays = False
+    flopy.mf6.ModflowTdis(sim, time_units='seconds', nper=1, perioddata=[(1., 1, 1)])
+    ml = flopy.mf6.ModflowGwf(sim, modelname='ml')
+    ims = flopy.mf6.ModflowIms(sim, outer_maximum=100, outer_dvclose=1e-5,
+            inner_maximum=50, inner_dvclose=1e-6, rcloserecord=[1e-5,'STRICT'])
+    sim.register_ims_package(ims, [ml.name])
+    flopy.mf6.ModflowGwfdisv(ml, length_units='METERS', nlay=1, ncpl=n*n,
+            nvert=len(vertices), vertices=vertices, cell2d=cell2d, top=30., botm=-20.)
+    flopy.mf6.ModflowGwfic(ml, strt=15.)
+    flopy.mf6.ModflowGwfnpf(ml, icelltype=0, k=1e-4, save_flows=True,
+            save_specific_discharge=True)
+    flopy.mf6.ModflowGwfghb(ml, stress_period_data=[[(0,node), 22., 1e-3*delr, 'ghb']
+        for node in bc_nodes['ghb']], boundnames=True, save_flows=True)
+    flopy.mf6.ModflowGwfrcha(ml, recharge=3e-9, save_flows=True)
+    flopy.mf6.ModflowGwfwel(ml, stress_period_data=[[(0,node), -0.05, name]
+        for name,node in bc_nodes['wel'].items()], boundnames=True, save_flows=True)
+    flopy.mf6.ModflowGwfdrn(ml, stress_period_data=[[(0,node), 8., 1e-2*delr, name]
+        for name,nodes in bc_nodes['drn'].items() for node in nodes],
+        boundnames=True, save_flows=True,
+        observations={os.path.join('sim','drn.csv'):[(name,'DRN',name) for name in drn_names]})
+    flopy.mf6.ModflowGwfriv(ml, auxiliary=['fid'], stress_period_data=[
+        [(0,node), 10., 1e-2*delr, 9., fid, name]
+        for fid,(name,nodes) in enumerate(bc_nodes['riv'].items()) for node in nodes],
+        boundnames=True, save_flows=True)
+    flopy.mf6.ModflowGwfoc(ml, saverecord=[('HEAD','LAST'),('BUDGET','LAST')],
+            head_filerecord=['ml.hds'], budget_filerecord=['ml.cbc'])
+
+    # external files, as set by setup_ml.py
+    ml.npf.k.store_as_external_file(os.path.join('..','com_ext','k.txt'))
+    ml.ghb.stress_period_data.store_as_external_file(os.path.join('..','com_ext','ghb_spd.txt'))
+    ml.rcha.recharge.store_as_external_file(os.path.join('..','com_ext','rech_spd.txt'))
+    ml.ic.strt.store_as_external_file(os.path.join('ext','strt.txt'))
+    for pak in ['wel','drn','riv']:
+        ml.get_package(pak).stress_period_data.store_as_external_file(
+                os.path.join('ext',f'{pak}_spd_01.txt'))
+    sim.write_simulation(silent=True)
+
+    # particle release geometries
+    well_shp = os.path.join(root,'wells.shp')
+    drn_shp = os.path.join(root,'drains.shp')
+    gpd.GeoDataFrame({'fid':wel_names}, geometry=[Point(xc[node],yc[node])
+        for node in bc_nodes['wel'].values()]).to_file(well_shp)
+    gpd.GeoDataFrame({'fid':drn_names}, geometry=[
+        LineString([(xc[nodes[0]],yc[nodes[0]]),(xc[nodes[-1]],yc[nodes[-1]])])
+        for nodes in bc_nodes['drn'].values()]).to_file(drn_shp)
+
+    # mp7 setup
+    pg = ParticleGenerator(ml=ml)
+    pg.gen_points(well_shp, n=n_part)
+    pg.gen_points(drn_shp, n=n_part)
+    particlegroups = pg.get_particlegroups(pgid_file=os.path.join(case_dir,'pgroups.csv'))
+    mp = flopy.modpath.Modpath7(modelname='mp', flowmodel=ml, exe_name='mp7', model_ws=case_dir)
+    flopy.modpath.Modpath7Bas(mp, porosity=0.1, defaultiface={'RCH': 6, 'EVT': 6})
+    flopy.modpath.Modpath7Sim(mp, simulationtype=simulationtype,
+            trackingdirection='backward', weaksinkoption='stop_at',
+            weaksourceoption='stop_at', budgetoutputoption='no',
+            stoptimeoption='extend', particlegroups=particlegroups)
+    mp.write_input()
+
+    return(case_dir)
+
+#-----------------------------------#
+#    timers
+#-----------------------------------#
+
+# min and median wall time of func over repeat calls
+def time_func(func, repeat=repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None: setup()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-t0)
+    return({'wall_min':min(times), 'wall_median':float(np.median(times)), 'repeat':repeat})
+
+# time pre- and post-processing stages on synthetic files (no model run)
+def bench_io(n):
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        case_dir = write_synthetic_worker(root, n)
+        tpl_file = os.path.join(root,'k.txt.tpl')
+        riv_file = os.path.join(case_dir,'ext','riv_spd_01_1.txt')
+        par = np.loadtxt(os.path.join(root,'par.dat'), dtype=str, ndmin=2)
+        parnames, parvals = par[:,0], par[:,1].astype(float)
+        mr_df = pd.DataFrame([[0.5]*4], columns=drn_names+wel_names,
+                index=pd.Index([1.0],name='time'))
+        q_df, glob_df = helpers.compute_glob(case_dir, mr_df=mr_df, write=False)
+        stages = {
+            'tpl_compile':(lambda : helpers.compile_tpl(tpl_file), helpers._tpl_cache.clear),
+            'tpl_fill':(lambda : helpers.write_tpl(helpers.compile_tpl(tpl_file),
+                parnames, parvals, os.path.join(root,'com_ext','k.txt')), None),
+            # model files of a pest-free run (helpers.run without model runs), cold template cache 
+            'write_model_files':(lambda : helpers.write_model_files(cwd=case_dir), 
+                helpers._tpl_cache.clear),
+            'hash_inputs':(lambda : helpers.hash_case_inputs(case_dir), None),
+            'read_list':(lambda : listio.read_list(riv_file), None),
+            'write_list':(lambda : listio.write_list(riv_file, listio.read_list(riv_file)), None),
+            'read_heads':(lambda : helpers.read_heads(os.path.join(case_dir,'ml.hds')), None),
+            'compute_glob':(lambda : helpers.compute_glob(case_dir, mr_df=mr_df, write=False), None),
+            'write_sim':(lambda : helpers.write_sim(case_dir,
+                {'mr.csv':mr_df, 'q.csv':q_df, 'glob.csv':glob_df}), None),
+            }
+        for stage, (func, setup) in stages.items():
+            res = time_func(func, setup=setup)
+            results.append(dict(res, stage=stage, ncpl=n*n, n_part=0))
+    return(results)
+
+# cold start import time of import sets, in a new interpreter for each repeat
+# python : interpreter startup only, reference for the other stages
+# forward_run_nocase : forward_run.py (PstFrom layout, helpers shipped with it)
+# run in a worker dir without case, i.e. interpreter startup, imports and run_cases overhead
+def bench_imports(sets=import_sets):
+    results = []
+    for name, code in sets.items():
+        cmd = [sys.executable, '-c', code]
+        res = time_func(lambda : subprocess.run(cmd, check=True))
+        results.append(dict(res, stage=f'import_{name}', ncpl=0, n_part=0))
+    with tempfile.TemporaryDirectory() as root:
+        for py_module in ['helpers.py', 'listio.py']:
+            shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),py_module), root)
+        with open(os.path.join(root,'forward_run.py'),'w') as f:
+            f.write(sets['forward_run'] + '\n\ndef main():\n    helpers.run_cases()\n'
+                    "\nif __name__ == '__main__':\n    mp.freeze_support()\n    main()\n")
+        cmd = [sys.executable, 'forward_run.py']
+        res = time_func(lambda : subprocess.run(cmd, cwd=root, check=True, stdout=subprocess.DEVNULL))
+        results.append(dict(res, stage='forward_run_nocase', ncpl=0, n_part=0))
+    return(results)
+
+# time stages of a full forward run (mf6, mp7, post-processing)
+# stage timings are read from the run_cases log (see helpers.timed_stage)
+def bench_model(n, n_part, simulationtype='pathline'):
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        build_synthetic_model(root, n, n_part, simulationtype)
+        log_file = 'run_log.jsonl'
+        for i in range(repeat):
+            helpers.run_cases(root, log_file=log_file)
+        with open(os.path.join(root,log_file)) as f:
+            stats = [json.loads(l) for l in f]
+        stage_df = pd.DataFrame([stage for stat in stats for stage in stat['stages']])
+        # peak rss of the process running the cases (python stages, not per stage)
+        proc_maxrss = max([stat['proc_maxrss'] for stat in stats])
+        for stage, df in stage_df.groupby('stage', sort=False):
+            results.append({'stage':stage, 'ncpl':n*n, 'n_part':n_part,
+                'simulationtype':simulationtype,
+                'wall_min':df.wall.min(), 'wall_median':df.wall.median(),
+                'cpu_median':df.cpu.median(), 
+                'cpu_children_median':df.cpu_children.median(),
+                'maxrss_children':df.maxrss_children.max(),
+                'proc_maxrss':proc_maxrss, 'repeat':repeat})
+    return(results)
+
+#-----------------------------------#
+#    results
+#-----------------------------------#
+
+# benchmark metadata : commit, platform and package versions
+def get_metadata():
+    try:
+        commit = subprocess.run(['git','rev-parse','--short','HEAD'],
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    meta = {'commit':commit, 'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform':platform.platform(), 'python':platform.python_version(),
+            'numpy':np.__version__, 'pandas':pd.__version__}
+    for pkg in ['flopy','pyemu','tracktools']:
+        try:
+            meta[pkg] = getattr(__import__(pkg), '__version__', 'unknown')
+        except ImportError:
+            meta[pkg] = None
+    return(meta)
+
+# compare median wall times of two benchmark result files (ratio new/ref)
+def compare(ref_file, new_file):
+    dfs = []
+    for f in [ref_file, new_file]:
+        with open(f) as fh:
+            df = pd.DataFrame(json.load(fh)['results'])
+        if 'simulationtype' not in df.columns:
+            df['simulationtype'] = None
+        df['simulationtype'] = df.simulationtype.fillna('')
+        dfs.append(df.set_index(['stage','ncpl','n_part','simulationtype']).wall_median)
+    cmp_df = pd.concat(dfs, axis=1, keys=['ref','new'])
+    cmp_df['ratio'] = cmp_df.new/cmp_df.ref
+    return(cmp_df)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='forward run benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=grid_sizes,
+            help='number of cells along each side of the synthetic grid')
+    parser.add_argument('--nparts', type=int, nargs='+', default=part_counts,
+            help='number of particles per well and drain')
+    parser.add_argument('--models', action='store_true',
+            help='include mf6/mp7 runs (requires mf6, mp7, flopy and tracktools)')
+    parser.add_argument('--compare', nargs=2, metavar=('REF','NEW'),
+            help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        print(compare(*args.compare).to_string())
+        sys.exit(0)
+
+    print('Benchmarking module imports...')
+    results = bench_imports()
+    for n in args.sizes:
+        print(f'Benchmarking pre/post-processing, {n*n} cells...')
+        results += bench_io(n)
+        if args.models:
+            if shutil.which('mf6') is None or shutil.which('mp7') is None:
+                print('mf6 or mp7 not found, skipping model runs')
+                continue
+            for n_part in args.nparts:
+                for simulationtype in ['pathline','endpoint']:
+                    print(f'Benchmarking forward run, {n*n} cells, {n_part} particles ({simulationtype})...')
+                    results += bench_model(n, n_part, simulationtype)
+
+    meta = get_metadata()
+    if not os.path.exists(bench_dir):
+        os.mkdir(bench_dir)
+    out_file = os.path.join(bench_dir, f"bench_{meta['commit']}.json")
+    with open(out_file,'w') as f:
+        json.dump({'meta':meta, 'results':results}, f, indent=1)
+    print(pd.DataFrame(results).to_string())
+    print(f'Results written to {out_file}')
@@ -0,0 +1,241 @@
+import os, sys
+import socket
+import subprocess
+import time
+
+# resident forward run server, one per worker dir
+# pestpp model command : python3 fwd_daemon.py
+# the client (this script, without arguments) asks the daemon of the worker dir
+# to run forward_run.py and waits for completion. The daemon preloads pyemu,
+# helpers and tracktools once and forks a child process for each run, so that 
+# imports are paid once per worker. The static TrackingAnalyzer data of the cases 
+# (helpers.load_ta_static) are loaded by the daemon at start and refreshed after 
+# each run, so that children inherit them. Runs are served one at a time. When the client
+# is killed (e.g. overdue run abandoned by PEST++), the child and its model 
+# sub-processes are terminated before the next run is accepted.
+# The daemon is started by the first client and exits after idle_timeout seconds
+# without runs, or when its worker dir is removed.
+# Unix only (Unix socket, fork) : without daemon (e.g. Windows, failed start),
+# forward_run.py is run by a new interpreter.
+
+# socket file, relative to worker dir
+sock_file = 'fwd_daemon.sock'
+
+# daemon log : start, stop and failed runs only
+log_file = 'fwd_daemon.log'
+
+# output of the last run (forward_run.py, models), overwritten at each run
+run_log_file = 'fwd_daemon_run.log'
+
+# max size (bytes) of the daemon log, cleared when exceeded at daemon start
+max_log_size = 2**20
+
+# idle time (s) before the daemon exits
+idle_timeout = 600
+
+# max time (s) for the daemon to start (imports)
+start_timeout = 60
+
+# lines of the run log sent back to the client for failed runs
+tail_lines = 50
+
+#-----------------------------------#
+#    daemon
+#-----------------------------------#
+
+# run forward_run.py in a forked child, output to run_log_file
+# returns the pid of the child (process group leader)
+def fork_run():
+    import runpy
+    import traceback
+    pid = os.fork()
+    if pid > 0:
+        return(pid)
+    # child : own process group, so that model sub-processes are killed with it
+    os.setpgid(0, 0)
+    fd = os.open(run_log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    code = 0
+    try:
+        runpy.run_path('forward_run.py', run_name='__main__')
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+# wait for run child, terminated when the client connection is closed
+# returns exit code of the child, None when the run was abandoned
+def wait_run(pid, conn):
+    import select
+    import signal
+    # pid file descriptor (linux) wakes up select when the child exits, else polling
+    fds = [conn]
+    if hasattr(os, 'pidfd_open'):
+        fds.append(os.pidfd_open(pid))
+    try:
+        while True:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid != 0:
+                return(os.waitstatus_to_exitcode(status))
+            readable, _, _ = select.select(fds, [], [], 0.05)
+            if conn in readable and len(conn.recv(1)) == 0:
+                # client gone : kill child and model sub-processes
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                os.waitpid(pid, 0)
+                return(None)
+    finally:
+        for fd in fds[1:]:
+            os.close(fd)
+
+# last lines of the run log
+def get_run_tail(n=tail_lines):
+    try:
+        with open(run_log_file) as f:
+            return(''.join(f.readlines()[-n:]))
+    except OSError:
+        return('')
+
+# serve forward runs from cwd
+def serve(idle_timeout=idle_timeout):
+    # modules shipped with the worker dir first, as for forward_run.py
+    sys.path.insert(0, os.getcwd())
+    import pyemu
+    import helpers
+    try:
+        import tracktools
+    except ImportError:
+        pass
+    # static tracking data inherited by forked runs
+    if 'tracktools' in sys.modules:
+        helpers.warm_ta_cache('.')
+    if os.path.exists(sock_file):
+        os.remove(sock_file)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_file)
+    server.listen(1)
+    # wake up regularly to check idle time and worker dir
+    server.settimeout(min(10, idle_timeout))
+    print(f'fwd_daemon : started at {time.strftime("%Y-%m-%dT%H:%M:%S")}, pid {os.getpid()}')
+    sys.stdout.flush()
+    last_run = time.time()
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if time.time() - last_run > idle_timeout or not os.path.exists(sock_file):
+                    break
+                continue
+            conn.settimeout(None)
+            with conn:
+                cmd = conn.makefile('r').readline().strip()
+                if cmd == 'stop':
+                    conn.sendall(b'0\n')
+                    break
+                code = wait_run(fork_run(), conn)
+                run_time = time.strftime('%Y-%m-%dT%H:%M:%S')
+                if code is None:
+                    print(f'fwd_daemon : {run_time} run abandoned by client, terminated')
+                elif code != 0:
+                    print(f'fwd_daemon : {run_time} run failed (exit code {code})')
+                    print(get_run_tail())
+                sys.stdout.flush()
+                if code is not None:
+                    reply = f'{code}\n' + (get_run_tail() if code != 0 else '')
+                    try:
+                        conn.sendall(reply.encode())
+                    except OSError:
+                        # client killed after completion
+                        pass
+            # reload static data modified by the run (cache of the child is lost)
+            if 'tracktools' in sys.modules:
+                helpers.warm_ta_cache('.')
+            last_run = time.time()
+    finally:
+        server.close()
+        if os.path.exists(sock_file):
+            os.remove(sock_file)
+        print(f'fwd_daemon : stopped at {time.strftime("%Y-%m-%dT%H:%M:%S")}')
+
+#-----------------------------------#
+#    client
+#-----------------------------------#
+
+# send command to the daemon of worker dir, returns (status, message)
+# returns None when no daemon is listening
+def request(cmd='run', worker_dir='.'):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.path.join(worker_dir, sock_file))
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return(None)
+    with client:
+        client.sendall((cmd + '\n').encode())
+        reply = client.makefile('r').read()
+    if len(reply) == 0:
+        # daemon died during the run
+        return(1, 'fwd_daemon : no reply from daemon')
+    status, _, msg = reply.partition('\n')
+    return(int(status), msg)
+
+# start daemon in cwd, detached from the client
+# returns True when the daemon is listening
+def start_daemon():
+    if os.path.exists(sock_file):
+        # stale socket of a dead daemon
+        os.remove(sock_file)
+    if os.path.exists(log_file) and os.path.getsize(log_file) > max_log_size:
+        os.remove(log_file)
+    with open(log_file, 'a') as f:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve'],
+                stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT,
+                start_new_session=True)
+    t0 = time.time()
+    while not os.path.exists(sock_file):
+        if proc.poll() is not None or time.time() - t0 > start_timeout:
+            return(False)
+        time.sleep(0.05)
+    return(True)
+
+# run forward_run.py through the daemon of cwd
+# falls back to a new interpreter when Unix sockets are not available (Windows) 
+# or the daemon cannot be reached
+def run_forward():
+    res = None
+    if hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork'):
+        try:
+            res = request('run')
+            if res is None and start_daemon():
+                res = request('run')
+        except Exception as e:
+            print(f'fwd_daemon : {e!r}')
+            res = None
+    if res is None:
+        print('fwd_daemon : no daemon, running forward_run.py')
+        return(subprocess.call([sys.executable, 'forward_run.py']))
+    status, msg = res
+    if status != 0:
+        print(msg)
+    return(status)
+
+# stop daemon of worker dir, if any
+def stop(worker_dir='.'):
+    request('stop', worker_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve()
+    elif len(sys.argv) > 1 and sys.argv[1] == '--stop':
+        stop()
+    else:
+        sys.exit(run_forward())
@@ -1,130 +1,685 @@
-import os, shutil
-import pyemu
-import pandas as pd 
-import os
-import multiprocessing as mp
+import os, sys, shutil
+import fnmatch
+import glob
+import hashlib
+import itertools
+import json
+import re
+import subprocess
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: # windows
+    resource = None
 import numpy as np
 import pandas as pd
-import pyemu
+import listio
+# pyemu, tracktools, cProfile and scipy are imported by the functions using them.
+# mind that forward_run.py written by PstFrom imports pyemu anyway : this only 
+# lightens scripts importing helpers alone (e.g. swp.py workers, bench.py)
 
  
-# pest-free run from par and template files  
-def run(par_file = 'par.dat', info_file='ml_info.csv', cwd='.'):
+# compiled template layouts, indexed by template file path 
+_tpl_cache = {}
+
+# parse template file into literal segments and parameter slots
+# layout is cached and only re-compiled when the template file is modified
+# commas are replaced by spaces unless keep_commas=True (csv model files)
+def compile_tpl(tpl_file, keep_commas=False):
+    tpl_file = os.path.abspath(tpl_file)
+    mtime = os.stat(tpl_file).st_mtime_ns
+    tpl = _tpl_cache.get((tpl_file, keep_commas))
+    if tpl is not None and tpl['mtime'] == mtime:
+        return(tpl)
+    with open(tpl_file) as f:
+        delim = f.readline().split()[1] # ptf ~
+        text = f.read()
+    # alternating literal segments and parameter names
+    items = re.split(r'{0}\s*(\S+?)\s*{0}'.format(re.escape(delim)), text)
+    tpl = {'mtime':mtime,
+            # csv layout of tpl files, whitespace layout of model files
+            'literals':[lit if keep_commas else lit.replace(',',' ') for lit in items[::2]],
+            'parnames':np.array(items[1::2])}
+    _tpl_cache[(tpl_file, keep_commas)] = tpl
+    return(tpl)
+
+# fill compiled template with parameter values and write model file 
+def write_tpl(tpl, parnames, parvals, ml_file):
+    # index of template parameters in parameter value arrays
+    sorter = np.argsort(parnames)
+    pos = np.searchsorted(parnames, tpl['parnames'], sorter=sorter).clip(0,len(parnames)-1)
+    idx = sorter[pos]
+    missing = parnames[idx] != tpl['parnames']
+    if missing.any():
+        raise Exception('parameter(s) missing from parameter file : {0}'.format(
+            ', '.join(np.unique(tpl['parnames'][missing]))))
+    items = [None]*(2*len(idx)+1)
+    items[::2] = tpl['literals']
+    items[1::2] = np.char.mod('%.10G', parvals[idx])
+    with open(ml_file,'w') as f:
+        f.write(''.join(items))
+
+# write model files of templates listed in info file, from parameter value file
+def write_model_files(par_file = 'par.dat', info_file='ml_info.csv', cwd='.'):
     # read info file 
     info_df = pd.read_csv(os.path.join(cwd,info_file))
-    for tpl_file,col_idx in zip(info_df.tpl_file,info_df.col_idx):
-        # read parameter value file 
-        parval_df = pd.read_csv(os.path.join(cwd,par_file),header=None,
-                delim_whitespace=True, names = ['parnme','value'],
-                index_col='parnme')
-        # read tpl 
-        tpl_df = pd.read_csv(os.path.join(cwd,tpl_file),skiprows=1,header=None)
-
-        # get parameter names 
-        row_idx = tpl_df[col_idx].str.startswith('~') # rows with parameters 
-        parnames = tpl_df.loc[row_idx,col_idx].str.extract(r'~\s*(\S+)\s*~')[0].tolist()
-
-        # get parameter values
-        parvals = parval_df.loc[parnames,'value'].values
-
-        # setup model parameter file 
-        mlfile_df = tpl_df.copy()
-        mlfile_df.loc[row_idx,col_idx] = parvals
-
+    # read parameter value file (once for all templates)
+    par = np.loadtxt(os.path.join(cwd,par_file), dtype=str, ndmin=2)
+    parnames, parvals = par[:,0], par[:,1].astype(float)
+    for tpl_file in info_df.tpl_file:
+        tpl = compile_tpl(os.path.join(cwd,tpl_file))
         # write model file 
         mlfile = os.path.join(cwd,'ext',tpl_file.replace('.tpl',''))
-        with open(mlfile,'w') as f:
-            f.write(mlfile_df.to_string(index=False,header=False))
+        write_tpl(tpl, parnames, parvals, mlfile)
+
+# pest-free run from par and template files  
+def run(par_file = 'par.dat', info_file='ml_info.csv', cwd='.'):
+    write_model_files(par_file, info_file, cwd)
 
     # run model 
     run_case(case_dir=cwd)
 
 
 # run simulation case only
-def run_sim():
-    run_case(case_dir='ml_99')
+def run_sim(cwd='.', **kwargs):
+    run_case(case_dir=os.path.join(cwd,'ml_99'), **kwargs)
+
+# list case directories (ml_XX) in cwd
+def list_case_dirs(cwd='.'):
+    return(sorted([d for d in os.listdir(cwd) 
+        if (os.path.isdir(os.path.join(cwd,d)) and d.startswith('ml_'))]))
+
+# infer case id from case dir name (ml_XX), defaults to 99
+def get_case_id(case_dir):
+    try:
+        return(int(os.path.basename(os.path.abspath(case_dir)).split('_')[1]))
+    except (IndexError, ValueError):
+        return(99)
 
 #  run series of cases 
-def run_cases(cwd='.', cases_dirs = None):
+# cases are independent : with nproc > 1, they are run in a bounded process pool.
+# a failing case does not stop the others, failures are reported in the 
+# summary file and raised once all cases have been processed.
+# all paths are resolved from cwd, the working directory of the process is 
+# left unchanged so that run_cases can be called from threads.
+# with log_file, per-stage timings of each case are appended to log_file (json lines)
+# additional keyword arguments are passed to run_case
+def run_cases(cwd='.', cases_dirs = None, nproc=1, summary_file='run_summary.csv', 
+        log_file=None, **kwargs):
     print("running models")
-    bwd = os.getcwd()
-    os.chdir(cwd)
+    root = os.path.abspath(cwd)
     if cases_dirs == None : 
-        cases_dirs = [d for d in os.listdir() if (os.path.isdir(d) and d.startswith('ml_'))]
-    for case_dir in cases_dirs :
-        run_case(case_dir=case_dir)
-    os.chdir(bwd)
-
-# run single case 
-def run_case(case_dir='.'):
+        cases_dirs = list_case_dirs(root)
+    case_paths = [os.path.join(root,case_dir) for case_dir in cases_dirs]
+    kwargs['log'] = log_file is not None
+    if nproc > 1 and len(case_paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(nproc,len(case_paths))) as pool:
+            futures = [pool.submit(try_run_case, case_path, **kwargs) for case_path in case_paths]
+            stats = []
+            for case_path, future in zip(case_paths, futures):
+                # process crashes (e.g. broken pool) are reported as case failures
+                try:
+                    stats.append(future.result())
+                except Exception as e:
+                    stats.append({'case':os.path.basename(case_path), 'status':'failed',
+                        'time':np.nan, 'error':repr(e)})
+    else:
+        stats = [try_run_case(case_path, **kwargs) for case_path in case_paths]
+    # per-case timing and exit status 
+    summary_df = pd.DataFrame(stats,
+            columns=['case','status','time','error']).set_index('case')
+    if summary_file is not None:
+        summary_df.to_csv(os.path.join(root,summary_file))
+    if log_file is not None:
+        run_time = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with open(os.path.join(root,log_file),'a') as f:
+            for stat in stats:
+                f.write(json.dumps(dict(stat, run=run_time)) + '\n')
+    failed = summary_df.index[summary_df.status == 'failed'].to_list()
+    if len(failed) > 0:
+        raise Exception('run_cases() failed for case(s) in {0} : {1}'.format(
+            root, ', '.join(failed)))
+    return(summary_df)
+
+# run cases of several worker directories from a single process
+# workers are run in a thread pool, model runs are sub-processes 
+# returns a dic of run summaries (or exceptions) indexed by worker dir
+def run_workers(worker_dirs, nthreads=None, **kwargs):
+    if nthreads is None: 
+        nthreads = len(worker_dirs)
+    with ThreadPoolExecutor(max_workers=max(1,nthreads)) as pool:
+        futures = {d:pool.submit(run_cases, d, **kwargs) for d in worker_dirs}
+    results = {}
+    for d, future in futures.items():
+        try:
+            results[d] = future.result()
+        except Exception as e:
+            results[d] = e
+    return(results)
+
+# file name patterns of immutable inputs, hard-linked across worker dirs
+# the grb file is rewritten by mf6 at each run and is not shared
+shared_patterns = ('*.disv','*.nam','*.tdis','*.ims','*.ic','*.npf','*.ghb','*.rcha',
+        '*.obs','*.oc','*.wel','*.drn','*.riv','*.mpnam','*.mpbas','*.mpsim',
+        'pgroups.csv','riv_ids.csv','*.tpl','*.ins')
+
+# dirs with mutable files (parameter-driven inputs, outputs), always private copies
+private_dirs = ('ext','sim')
+
+# replicate template dir into worker dir
+# immutable inputs are hard-linked (read-only, never written by runs),
+# other files are copied. Falls back to copies when links are not supported.
+def provision_worker(template_dir, worker_dir):
+    for root, dirs, files in os.walk(template_dir):
+        dest = os.path.join(worker_dir, os.path.relpath(root, template_dir))
+        os.makedirs(dest, exist_ok=True)
+        shared = os.path.basename(root) not in private_dirs
+        for f in files:
+            src, dst = os.path.join(root,f), os.path.join(dest,f)
+            if shared and any([fnmatch.fnmatch(f,p) for p in shared_patterns]):
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(src, dst)
+
+# start pest master and workers on local host, with worker dirs from provision_worker
+# same arguments as pyemu.helpers.start_workers(), which copies full worker dirs. 
+# Supported options : worker_root, master_dir, port, local, cleanup, verbose, silent_master.
+# Not supported : rel_path, reuse_master, restart, ppw_function, ppw_kwargs.
+# Linked files must never be edited in worker dirs (shared with the template dir).
+def start_linked_workers(worker_dir, exe_rel_path, pst_rel_path, num_workers,
+        worker_root='..', master_dir=None, port=4004, local=True, cleanup=True,
+        verbose=False, silent_master=False):
+    # host name of the master, as in pyemu.helpers.start_workers()
+    if local is True:
+        hostname = 'localhost'
+    elif isinstance(local, str):
+        hostname = local
+    else:
+        import socket
+        hostname = socket.gethostname()
+    master_p = None
+    if master_dir is not None:
+        if os.path.exists(master_dir):
+            shutil.rmtree(master_dir)
+        shutil.copytree(worker_dir, master_dir)
+        out = subprocess.DEVNULL if silent_master else None
+        master_p = subprocess.Popen([exe_rel_path, pst_rel_path, '/h', f':{port}'],
+                cwd=master_dir, stdout=out, stderr=out)
+        # let the master open the port
+        time.sleep(1.5)
+    procs, worker_dirs = [], []
+    for i in range(num_workers):
+        new_worker_dir = os.path.join(worker_root, f'worker_{i}')
+        if os.path.exists(new_worker_dir):
+            shutil.rmtree(new_worker_dir)
+        provision_worker(worker_dir, new_worker_dir)
+        worker_dirs.append(new_worker_dir)
+        out = None if verbose else subprocess.DEVNULL
+        procs.append(subprocess.Popen(
+            [exe_rel_path, pst_rel_path, '/h', f'{hostname}:{port}'],
+            cwd=new_worker_dir, stdout=out, stderr=out))
+    if master_p is not None:
+        master_p.wait()
+        time.sleep(0.5)
+        for p in procs:
+            p.kill()
+    for p in procs:
+        p.wait()
+    if cleanup:
+        for d in worker_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+    if master_p is not None and master_p.returncode != 0:
+        raise Exception('start_linked_workers() master returned non-zero: {0}'.format(
+            master_p.returncode))
+
+# run single case, catching errors
+# stage timings are returned with log=True, with the peak rss of model runs of the case
+# (models_maxrss) and the peak rss of the process (high-water mark over its lifetime)
+def try_run_case(case_dir='.', log=False, **kwargs):
+    t0 = time.perf_counter()
+    stages = [] if log else None
+    try:
+        status = run_case(case_dir=case_dir, stages=stages, **kwargs)
+        error = ''
+    except Exception as e:
+        traceback.print_exc()
+        status, error = 'failed', repr(e)
+    stat = {'case':os.path.basename(os.path.abspath(case_dir)), 'status':status,
+        'time':time.perf_counter()-t0, 'error':error, 'pid':os.getpid(), 'stages':stages}
+    if log:
+        rss = [stage['maxrss_children'] for stage in stages if 'maxrss_children' in stage]
+        stat['models_maxrss'] = max(rss) if len(rss) > 0 else np.nan
+        stat['proc_maxrss'] = peak_rss()
+    return(stat)
+
+# run executable from cwd, without changing the working dir of the process 
+# returns resource usage of the run : cpu time (s) and peak rss (MB) of the executable,
+# collected with wait4 for this process only (valid when cases are run in threads)
+def run_model(args, cwd='.'):
+    p = subprocess.Popen(args, cwd=cwd)
+    if hasattr(os, 'wait4'):
+        _, status, ru = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        usage = {'cpu_children':ru.ru_utime + ru.ru_stime, 
+                'maxrss_children':ru.ru_maxrss/rss_scale}
+    else: # windows
+        p.wait()
+        usage = {'cpu_children':np.nan, 'maxrss_children':np.nan}
+    if p.returncode != 0:
+        raise Exception('{0} returned non-zero exit status {1} in {2}'.format(
+            ' '.join(args), p.returncode, cwd))
+    return(usage)
+
+# run single case, returns run status ('ok' or 'skipped')
+# intermediate results are passed in memory, sim files are written at the end
+# incremental=True : the run is skipped when case inputs are unchanged since the 
+# last successful run, simulated values are then restored from the case manifest
+# warm_start=True : mf6 initial heads are seeded from the last converged solution 
+# stages : list where stage timings are appended (see timed_stage)
+# profile=True : python stages are profiled with cProfile, stats dumped to pproc.prof
+# scratch_root : model outputs are written to a scratch dir in scratch_root (e.g. /dev/shm),
+# only sim/*.csv files are copied back to the case dir (see make_scratch_case)
+def run_case(case_dir='.', batch_write=False, incremental=False, warm_start=False,
+        stages=None, profile=False, scratch_root=None):
     ml_name = 'ml'
     mp_name = 'mp'
-    # run flow model
-    pyemu.os_utils.run('mf6', cwd=case_dir)
-    # run particle tracking
-    pyemu.os_utils.run('mp7 mp', cwd=case_dir)
-    # post-proc particle tracking
-    ptrack_pproc(case_dir, ml_name, mp_name)
-    # compute global q and mr 
-    compute_glob(case_dir)
+    if incremental:
+        with timed_stage(stages, 'hash'):
+            in_hash = hash_case_inputs(case_dir)
+            skip = restore_sim(case_dir, in_hash)
+        if skip:
+            print(f'{case_dir} : inputs unchanged, skipping run')
+            return('skipped')
+        # no valid manifest until the run completes
+        clear_manifest(case_dir)
+    work_dir = case_dir if scratch_root is None else make_scratch_case(case_dir, scratch_root)
+    prof = None
+    try:
+        # run flow model
+        with timed_stage(stages, 'mf6') as stage:
+            if warm_start:
+                stage.update(run_mf6_warm(work_dir, ml_name))
+            else:
+                stage.update(run_model(['mf6'], cwd=work_dir))
+        # run particle tracking
+        with timed_stage(stages, 'mp7') as stage:
+            stage.update(run_model(['mp7', mp_name], cwd=work_dir))
+        if profile:
+            import cProfile
+            prof = cProfile.Profile()
+            prof.enable()
+        # post-proc particle tracking
+        mr_df = ptrack_pproc(work_dir, ml_name, mp_name, write=False, stages=stages)
+        # compute global q and mr 
+        with timed_stage(stages, 'compute_glob'):
+            q_df, glob_df = compute_glob(work_dir, mr_df=mr_df, write=False)
+        # write simulated values, once at the end of the run
+        with timed_stage(stages, 'write_sim'):
+            write_sim(work_dir, {'mr.csv':mr_df, 'q.csv':q_df, 'glob.csv':glob_df}, batch=batch_write)
+            if work_dir != case_dir:
+                for sim_file in glob.glob(os.path.join(work_dir,'sim','*.csv')):
+                    shutil.copy(sim_file, os.path.join(case_dir,'sim'))
+    finally:
+        # stats are dumped even when post-processing fails
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(os.path.join(case_dir,'pproc.prof'))
+        if work_dir != case_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if incremental:
+        write_manifest(case_dir, in_hash)
+    return('ok')
+
+# set up scratch dir of case in scratch_root, where model outputs are written
+# inputs are symbolic links to the case dir : the ext dir is linked as a whole 
+# (warm start updates ext/strt.txt of the case dir) and com_ext is linked next to it.
+# the scratch path only depends on the case dir (stable TrackingAnalyzer cache key)
+def make_scratch_case(case_dir, scratch_root):
+    case_dir = os.path.abspath(case_dir)
+    root = os.path.dirname(case_dir)
+    scratch_dir = os.path.join(scratch_root, 
+            'case_study_' + hashlib.sha1(root.encode()).hexdigest()[:12])
+    work_dir = os.path.join(scratch_dir, os.path.basename(case_dir))
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(os.path.join(work_dir,'sim'))
+    # cases may be set up concurrently 
+    try:
+        os.symlink(os.path.join(root,'com_ext'), os.path.join(scratch_dir,'com_ext'))
+    except FileExistsError:
+        pass
+    os.symlink(os.path.join(case_dir,'ext'), os.path.join(work_dir,'ext'))
+    for f in os.listdir(case_dir):
+        src = os.path.join(case_dir,f)
+        if os.path.isfile(src) and not f.endswith(output_exts):
+            os.symlink(src, os.path.join(work_dir,f))
+    return(work_dir)
+
+# ru_maxrss in kB on linux, in bytes on mac
+rss_scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+
+# peak resident set size (MB) of current process
+# high-water mark over the lifetime of the process, not per case or stage
+def peak_rss():
+    if resource is None:
+        return(np.nan)
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/rss_scale)
+
+# append wall time and cpu time of enclosed stage to stages list
+# cpu : cpu time of the calling thread (python stages).
+# yields the stage record, updated by model stages with the resource usage 
+# of the model run (cpu_children, maxrss_children, see run_model)
+# stages is None : nothing is recorded
+@contextmanager
+def timed_stage(stages, name):
+    stage = {'stage':name}
+    if stages is None:
+        yield(stage)
+        return
+    t0, c0 = time.perf_counter(), time.thread_time()
+    try:
+        yield(stage)
+    finally:
+        stage.update({'wall':time.perf_counter()-t0, 'cpu':time.thread_time()-c0})
+        stages.append(stage)
+
+# initial heads (ic) external file, relative to case dir
+strt_file = os.path.join('ext','strt.txt')
+
+# read last saved heads of binary head file (all layers, flattened)
+def read_heads(hds_file):
+    mm = np.memmap(hds_file, dtype=np.uint8, mode='r')
+    i4 = np.dtype('<i4')
+    heads = {}
+    pos = 0
+    while pos < mm.size:
+        # kstp, kper, pertim, totim, text, ncol, nrow, ilay
+        ncol, nrow, ilay = np.frombuffer(mm, i4, 3, pos+40)
+        pos += 52
+        n = int(ncol)*int(nrow)
+        heads[int(ilay)] = np.frombuffer(mm, '<f8', n, pos).copy()
+        pos += 8*n
+    return(np.concatenate([heads[k] for k in sorted(heads)]))
+
+# run mf6 from initial heads of the last converged run of the case
+# heads of a converged run are saved to the ic file for the next run
+# falls back to the original initial heads (written by setup_ml) when mf6 fails
+def run_mf6_warm(case_dir, ml_name='ml'):
+    ic_file = os.path.join(case_dir, strt_file)
+    ini_file = ic_file.replace('.txt','_ini.txt')
+    if not os.path.exists(ini_file):
+        shutil.copy(ic_file, ini_file)
+    try:
+        usage = run_model(['mf6'], cwd=case_dir)
+    except Exception:
+        print(f'{case_dir} : mf6 failed from warm start, restarting from initial heads')
+        shutil.copy(ini_file, ic_file)
+        usage = run_model(['mf6'], cwd=case_dir)
+    # seed initial heads of next run, invalid (dry) cells from initial heads
+    heads = read_heads(os.path.join(case_dir, ml_name + '.hds'))
+    with open(ini_file) as f:
+        strt = np.array(f.read().split(), dtype=float)
+    invalid = ~np.isfinite(heads) | (np.abs(heads) >= 1e30)
+    heads[invalid] = strt[invalid]
+    np.savetxt(ic_file, heads[None,:], fmt='%.10G')
+    return(usage)
+
+# name of case manifest file (input hash and simulated values of last successful run)
+manifest_file = 'manifest.json'
+
+# model output files, not considered in the input hash of a case
+output_exts = ('.hds', '.cbc', '.grb', '.lst', '.mpend', '.mppth', 
+        '.mplst', '.mplog', '.timeseries', '.json', '.prof')
+
+# content hash of case inputs : common com_ext files, case ext files and mf6/mp7 input files
+def hash_case_inputs(case_dir):
+    case_dir = os.path.abspath(case_dir)
+    root = os.path.dirname(case_dir)
+    com_ext_dir = os.path.join(root,'com_ext')
+    # initial heads are not considered (warm start)
+    in_files = sorted(glob.glob(os.path.join(com_ext_dir,'*'))) + \
+            [f for f in sorted(glob.glob(os.path.join(case_dir,'ext','*.txt')))
+                if not os.path.basename(f).startswith('strt')] + \
+            [f for f in sorted(glob.glob(os.path.join(case_dir,'*')))
+                    if os.path.isfile(f) and not f.endswith(output_exts)]
+    h = hashlib.sha1()
+    for f in in_files:
+        # paths relative to the worker dir, the hash does not depend on its location
+        h.update(os.path.relpath(f,root).encode())
+        with open(f,'rb') as fh:
+            h.update(fh.read())
+    return(h.hexdigest())
+
+# write case manifest with input hash and simulated values (sim/*.csv)
+def write_manifest(case_dir, in_hash):
+    sim = {}
+    for f in sorted(glob.glob(os.path.join(case_dir,'sim','*.csv'))):
+        with open(f) as fh:
+            sim[os.path.basename(f)] = fh.read()
+    with open(os.path.join(case_dir,manifest_file),'w') as f:
+        json.dump({'hash':in_hash, 'sim':sim}, f)
+
+# remove case manifest 
+def clear_manifest(case_dir):
+    if os.path.exists(os.path.join(case_dir,manifest_file)):
+        os.remove(os.path.join(case_dir,manifest_file))
+
+# restore simulated values from manifest when input hash matches 
+# returns False when there is no valid manifest for in_hash
+def restore_sim(case_dir, in_hash):
+    try:
+        with open(os.path.join(case_dir,manifest_file)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return(False)
+    if manifest.get('hash') != in_hash:
+        return(False)
+    # sim files may have been removed by PEST before the run
+    for sim_file, txt in manifest['sim'].items():
+        with open(os.path.join(case_dir,'sim',sim_file),'w') as f:
+            f.write(txt)
+    return(True)
+
+# static TrackingAnalyzer data (grid, particle groups, river ids), indexed by case dir
+# the cache lives in the interpreter : it is shared by runs of the same process 
+# (run_workers) and inherited by processes forked after it is filled (fwd_daemon)
+_ta_cache = {}
+
+# TrackingAnalyzer attributes set from static files, by grb_file, 
+# load_pgrp_names() and load_rivname_dic() respectively
+ta_static_attrs = ('grb', 'pgrpname_dic', 'rivname_dic')
+
+# load static TrackingAnalyzer attributes of case, from cache when possible.
+# the grb file is re-written by mf6 at each run : the cache is invalidated 
+# by modification of the static model files it derives from (disv, pgroups, riv)
+def load_ta_static(case_dir, ml_name='ml'):
 
-def ptrack_pproc(case_dir, ml_name, mp_name):
+    from tracktools import TrackingAnalyzer
+
+    case_dir = os.path.abspath(case_dir)
+    case_id = get_case_id(case_dir)
+    pgrpname_file = os.path.join(case_dir,'pgroups.csv')
+    key = tuple(os.stat(f).st_mtime_ns for f in [
+        os.path.join(case_dir,ml_name + '.disv'),
+        os.path.join(case_dir,ml_name + '.riv'),
+        pgrpname_file])
+
+    entry = _ta_cache.get(case_dir)
+    if entry is not None and entry['key'] == key:
+        return(entry['attrs'])
+
+    ta = TrackingAnalyzer(grb_file = os.path.join(case_dir,ml_name + '.disv.grb'))
+    ta.load_pgrp_names(pgrpname_file)
+    ta.load_rivname_dic(mfriv_file= os.path.join(case_dir,'ext', f'riv_spd_{case_id:02d}_1.txt'))
+    missing = [k for k in ta_static_attrs if getattr(ta, k, None) is None]
+    if len(missing) > 0:
+        raise Exception('load_ta_static() : TrackingAnalyzer attributes not found : ' 
+                f'{missing}, update ta_static_attrs or run ptrack_pproc with use_cache=False')
+    attrs = {k:getattr(ta, k) for k in ta_static_attrs}
+    _ta_cache[case_dir] = {'key':key, 'attrs':attrs}
+
+    return(attrs)
+
+# fill the TrackingAnalyzer cache for the case dirs of cwd 
+# cases without model outputs yet (grb file) are skipped
+def warm_ta_cache(cwd='.', ml_name='ml'):
+    for case_dir in list_case_dirs(cwd):
+        try:
+            load_ta_static(os.path.join(cwd, case_dir), ml_name)
+        except Exception as e:
+            print(f'warm_ta_cache() : {case_dir} skipped ({e!r})')
+
+# read modpath simulation type from mpsim file 
+# 1: endpoint, 2: pathline, 3: timeseries, 4: pathline and timeseries
+def get_mp_simtype(case_dir, mp_name='mp'):
+    with open(os.path.join(case_dir, mp_name + '.mpsim')) as f:
+        items = [l for l in f if not l.startswith('#')]
+    # item 3 : simulationtype trackingdirection ...
+    return(int(items[2].split()[0]))
+
+# columns of mp7 pathline point records (after the particle header line)
+# node x y z time xloc yloc zloc k stressperiod timestep
+pth_ncols = 11
+
+# keep first and last vertex of each pathline, and vertices where v crosses a multiple of step
+# v : cumulative distance or time along each pathline
+def decimate_pathlines(v, starts, counts, step):
+    v = v - np.repeat(v[starts], counts)
+    b = np.floor(v/step)
+    keep = np.ones(len(v), dtype=bool)
+    keep[1:] = b[1:] != b[:-1]
+    keep[starts] = True
+    keep[starts + counts - 1] = True
+    return(keep)
+
+# pathline vertices of buffered particles, one (n,2) array of x,y per particle
+def get_pathline_segments(lines, counts, min_dist=None, min_dt=None, xoff=0., yoff=0.):
+    pts = np.array(''.join(lines).split(), dtype=float).reshape(-1, pth_ncols)
+    counts = np.array(counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    xy = pts[:,1:3] + [xoff, yoff]
+    keep = np.ones(len(pts), dtype=bool)
+    if min_dist is not None:
+        d = np.hypot(*np.diff(xy, axis=0, prepend=xy[:1]).T)
+        keep &= decimate_pathlines(np.cumsum(d), starts, counts, min_dist)
+    if min_dt is not None:
+        keep &= decimate_pathlines(pts[:,4], starts, counts, min_dt)
+    ends = np.cumsum(np.add.reduceat(keep, starts))
+    return(np.split(xy[keep], ends[:-1]))
+
+# stream mp7 pathline file (mppth), yields (particle group, list of (n,2) x,y arrays)
+# particles are read by chunks of at most chunk_size particles of the same group,
+# so that memory is bounded by chunk_size whatever the number of particles.
+# vertices can be decimated by distance (min_dist, model length units) 
+# or tracking time (min_dt) along each pathline. 
+# mp7 coordinates are local to the grid, xoff and yoff are added (no grid rotation)
+def iter_pathlines(pth_file, chunk_size=1000, min_dist=None, min_dt=None, xoff=0., yoff=0.):
+    with open(pth_file) as f:
+        for line in f:
+            if line.strip().upper().startswith('END HEADER'):
+                break
+        else:
+            raise Exception(f'iter_pathlines() : no header found in {pth_file}')
+        lines, counts, group = [], [], None
+        for line in f:
+            items = line.split()
+            if len(items) == 0:
+                continue
+            # particle header : sequencenumber group particleid pathlinepointcount
+            pgroup, npts = int(items[1]), int(items[3])
+            if len(counts) > 0 and (pgroup != group or len(counts) == chunk_size):
+                yield(group, get_pathline_segments(lines, counts, min_dist, min_dt, xoff, yoff))
+                lines, counts = [], []
+            group = pgroup
+            block = list(itertools.islice(f, npts))
+            if len(block) < npts:
+                raise Exception(f'iter_pathlines() : truncated pathline file {pth_file}')
+            lines.extend(block)
+            counts.append(npts)
+        if len(counts) > 0:
+            yield(group, get_pathline_segments(lines, counts, min_dist, min_dt, xoff, yoff))
+
+# post-process particle tracking, returns mixing ratios (written to sim/mr.csv with write=True)
+# stages : list where stage timings are appended (see timed_stage)
+def ptrack_pproc(case_dir, ml_name, mp_name, use_cache=True, write=True, stages=None):
 
     print('Post-processing particle tracking data...')
 
     from tracktools import TrackingAnalyzer
 
-    #  attempt to infer case id from dir name 
-    try : 
-        case_id = int(case_dir.split('_')[1])
-    except :
-        case_id = 99
+    #  infer case id from dir name 
+    case_id = get_case_id(case_dir)
 
+    # the budget file is read by TrackingAnalyzer from its path (edp_cell_budget) :
+    # reading only the RIV/DRN/WEL records of endpoint cells has to be done in tracktools
     cbc_file = os.path.join(case_dir,ml_name + '.cbc')
     grb_file = os.path.join(case_dir,ml_name + '.disv.grb')
     endpoint_file = os.path.join(case_dir, mp_name + '.mpend')
     pathline_file = os.path.join(case_dir,mp_name + '.mppth')
+    # pathlines are not required for mixing ratios, skip them in endpoint mode
+    if get_mp_simtype(case_dir, mp_name) not in (2,4):
+        pathline_file = None
     mr_file = os.path.join(case_dir,'sim','mr.csv')
     pgrpname_file = os.path.join(case_dir,'pgroups.csv')
 
-    ta = TrackingAnalyzer(
-            endpoint_file=endpoint_file,
-            pathline_file=pathline_file,
-            cbc_file = cbc_file,
-            grb_file = grb_file,
-            )
-
-    ta.load_pgrp_names(pgrpname_file)
-    ta.load_rivname_dic(mfriv_file= os.path.join(case_dir,'ext', f'riv_spd_{case_id:02d}_1.txt'))
+    with timed_stage(stages, 'ta_load'):
+        if use_cache:
+            # only per-run files are read, static data are fetched from cache
+            ta = TrackingAnalyzer(
+                    endpoint_file=endpoint_file,
+                    pathline_file=pathline_file,
+                    cbc_file = cbc_file,
+                    )
+            for k, v in load_ta_static(case_dir, ml_name).items():
+                setattr(ta, k, v)
+        else:
+            ta = TrackingAnalyzer(
+                    endpoint_file=endpoint_file,
+                    pathline_file=pathline_file,
+                    cbc_file = cbc_file,
+                    grb_file = grb_file,
+                    )
+            ta.load_pgrp_names(pgrpname_file)
+            ta.load_rivname_dic(mfriv_file= os.path.join(case_dir,'ext', f'riv_spd_{case_id:02d}_1.txt'))
     
     # selection of river reaches to consider as contaminant source
     reach_list = ['THIL_AVAL','THIL_AMONT','MOULINAT_AMONT','GAJAC','BUSSAGUET_AMONT']
     agg_dic = {'river' : reach_list}
 
     # compute mixing ratio
-    mr = ta.compute_mixing_ratio(
-            #on='river',
-            on=agg_dic,
-            edp_cell_budget = True, 
-            v_weight = True
-            )
-
-    # write sim file
+    with timed_stage(stages, 'mixing_ratio'):
+        mr = ta.compute_mixing_ratio(
+                #on='river',
+                on=agg_dic,
+                edp_cell_budget = True, 
+                v_weight = True
+                )
+
+    # mixing ratios indexed by time (case id), as read from sim file
     if 'river' not in mr.columns : mr['river']=0.
     sim_df = pd.DataFrame(
-            [[f'{case_id:.1f}']+mr['river'].to_list()],
-            columns=['time']+mr.index.to_list()
+            [mr['river'].to_list()],
+            columns=mr.index.to_list(),
+            index=pd.Index([float(case_id)],name='time')
             )
-    sim_df.set_index('time',inplace=True)
-    sim_df.to_csv(mr_file)
+
+    # write sim file
+    if write:
+        sim_df.to_csv(mr_file)
+
+    return(sim_df)
 
 # compute global variables (Q and mr)
-def compute_glob(case_dir):
+# mixing ratios are read from sim/mr.csv when mr_df is not provided
+def compute_glob(case_dir, mr_df=None, write=True):
 
-    try:
-        case_id = int(case_dir.split('_')[1])
-    except:
-        case_id = 99
+    case_id = get_case_id(case_dir)
     
     # input files 
     mr_file = os.path.join(case_dir,'sim','mr.csv')
@@ -132,29 +687,40 @@ def compute_glob(case_dir):
     wel_file = os.path.join(case_dir,'ext',f'wel_spd_{case_id:02d}_1.txt')
 
     # load input files
-    mr_df = pd.read_csv(mr_file,index_col=0)
+    if mr_df is None:
+        mr_df = pd.read_csv(mr_file,index_col=0)
     q_df = pd.read_csv(drn_file,index_col=0)
 
     # fetch qwells from mf spd file
-    qwel_df = pd.read_csv(wel_file,
-            delim_whitespace=True,
-            names=['lay','node','q','name'])
-    qwel_df.name = qwel_df.name.str.upper()
-    qwel_df.set_index('name',inplace=True)
+    wel = listio.read_list(wel_file)
+    qwel = dict(zip(np.char.upper(wel['boundname']), wel['q']))
 
     # append well rates to q_df
-    q_df['R20'] = qwel_df.loc['R20','q']
-    q_df['R21'] = qwel_df.loc['R21','q']
+    q_df['R20'] = qwel['R20']
+    q_df['R21'] = qwel['R21']
 
     # global discharge rate and mr
     glob_df = pd.DataFrame(q_df.sum(axis=1),columns=['q'])
     glob_df['mr'] = (q_df*mr_df).sum(axis=1)/q_df.sum(axis=1)
 
     # write output csv files 
-    q_file = os.path.join(case_dir,'sim','q.csv')
-    glob_file = os.path.join(case_dir,'sim','glob.csv')
-    q_df.to_csv(q_file)
-    glob_df.to_csv(glob_file)
+    if write:
+        write_sim(case_dir, {'q.csv':q_df, 'glob.csv':glob_df})
+
+    return(q_df, glob_df)
+
+# write simulated values to case sim dir, from a dic of dataframes indexed by file name
+# batch=True : all csv files are formatted before being written 
+def write_sim(case_dir, sim_dic, batch=False):
+    sim_files = {os.path.join(case_dir,'sim',f):df for f,df in sim_dic.items()}
+    if batch:
+        sim_files = {f:df.to_csv() for f,df in sim_files.items()}
+        for f, txt in sim_files.items():
+            with open(f,'w') as fh:
+                fh.write(txt)
+    else:
+        for f, df in sim_files.items():
+            df.to_csv(f)
 
 # clear list of directories 
 def clear_dirs(dlist):
@@ -165,6 +731,117 @@ def clear_dirs(dlist):
 
 
 
+# keys of pyemu long observation names, e.g. oname:hds_otype:lst_usecol:p1_time:2.0
+obsname_keys = ['oname','otype','usecol','time']
+
+# parse long observation names into a dataframe with one column per key (same index)
+# values are truncated at the first '_' 
+def parse_obsnames(obsnmes, keys=obsname_keys):
+    obsnmes = pd.Series(obsnmes)
+    return(pd.concat([obsnmes.str.extract(f'(?:^|_){key}:([^_]*)', expand=False).rename(key)
+        for key in keys], axis=1))
+
+# observed values of (case, obs id) pairs from surveys dataframe (case ids as index, 
+# obs ids as columns). Missing values are returned as nan.
+def get_obsvals(surveys_df, cases, ids):
+    obs_keys = pd.DataFrame({'case':np.asarray(cases), 'id':np.asarray(ids)})
+    missing = set(obs_keys.id) - set(surveys_df.columns)
+    missing.update(set(obs_keys.case) - set(surveys_df.index))
+    if len(missing) > 0:
+        raise Exception('observation(s) or case(s) missing from surveys : {0}'.format(
+            ', '.join([str(m) for m in missing])))
+    surveys_long = surveys_df.rename_axis('case').reset_index().melt(
+            id_vars='case', var_name='id', value_name='obsval')
+    return(obs_keys.merge(surveys_long, on=['case','id'], how='left')['obsval'].values.astype(float))
+
+# observation weights from measurement error (sigma) of observation groups
+# with use_factor=True, weights are magnified by the tuning factor of the group
+def get_obs_weights(weights_df, obgnmes, use_factor=True):
+    grp_df = weights_df.loc[np.asarray(obgnmes)]
+    weights = 1./grp_df['sigma'].values
+    if use_factor:
+        weights = weights*grp_df['factor'].values
+    return(weights)
+
+# tie parameters of group pargp to those of a reference instance (e.g. first case)
+# parameters are matched across instances by key (long name without instance, i.e.
+# par name base, use col and index value), not by position. Index values are not taken
+# from the idx0 column, which is truncated at the first '_' (e.g. thil_aval, thil_amont)
+# raises when a parameter has no reference or the mapping is not one-to-one
+# returns the tied parameters with their reference (parnme_ref)
+def tie_pars(par, pargp, ref_inst=0):
+    grp = par.loc[par.pargp == pargp, ['parnme','inst']].copy()
+    grp['inst'] = grp['inst'].astype(int)
+    grp['key'] = grp.parnme.str.replace(r'inst:\d+_', '', regex=True)
+    ref = grp.loc[grp.inst == ref_inst, ['parnme','key']]
+    tied = grp.loc[grp.inst != ref_inst]
+    if ref.key.duplicated().any() or tied.duplicated(['inst','key']).any():
+        raise Exception(f'tie_pars() : duplicated parameter keys in group {pargp}')
+    tied = tied.merge(ref, on='key', how='left', suffixes=('','_ref'))
+    if tied.parnme_ref.isna().any():
+        raise Exception('tie_pars() : no reference parameter (inst {0}) for {1}'.format(
+            ref_inst, ', '.join(tied.parnme[tied.parnme_ref.isna()])))
+    par.loc[tied.parnme,'partrans'] = 'tied'
+    par.loc[tied.parnme,'partied'] = tied.parnme_ref.values
+    return(tied)
+
+# first-order pearson tikhonov regularization of pilot points from geostruct gs
+# same equations as pyemu.helpers.first_order_pearson_tikhonov() with the covariance 
+# matrix of gs, without the dense covariance matrix : only pairs of adjustable parameters 
+# within the search radius (beyond which correlation < drop_tol) are evaluated, 
+# with a kd-tree when scipy is available.
+def sparse_pearson_tikhonov(pst, gs, x, y, names, drop_tol=0.2, reset=False):
+    if drop_tol <= 0:
+        raise Exception('sparse_pearson_tikhonov() requires drop_tol > 0')
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    names = np.asarray(names, dtype=object)
+    adj = np.isin(names, pst.adj_par_names)
+    x, y, names = x[adj], y[adj], names[adj]
+    # pearson correlation for separation (dx, dy)
+    sill = gs.nugget + sum([v.contribution for v in gs.variograms])
+    def get_cc(dx, dy):
+        cc = np.zeros(len(dx))
+        for v in gs.variograms:
+            dxx, dyy = v._apply_rotation(dx, dy)
+            cc += v._h_function(np.sqrt(dxx*dxx + dyy*dyy))
+        return(cc/sill)
+    # search radius, in all directions (anisotropy)
+    radius = max([v.a for v in gs.variograms])
+    angles = np.linspace(0, np.pi, 37)
+    while (get_cc(radius*np.cos(angles), radius*np.sin(angles)) >= drop_tol).any():
+        radius *= 2
+    # pairs (i < j) within search radius
+    xy = np.column_stack([x, y])
+    try:
+        from scipy.spatial import cKDTree
+        pairs = cKDTree(xy).query_pairs(radius, output_type='ndarray').reshape(-1,2)
+    except ImportError:
+        pairs = [np.zeros((0,2), dtype=int)]
+        for i in range(len(xy)-1):
+            j = i + 1 + np.flatnonzero(np.hypot(xy[i+1:,0]-xy[i,0], xy[i+1:,1]-xy[i,1]) <= radius)
+            pairs.append(np.column_stack([np.full(len(j), i), j]))
+        pairs = np.concatenate(pairs)
+    pairs = pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+    i, j = pairs[:,0], pairs[:,1]
+    cc = get_cc(x[i]-x[j], y[i]-y[j])
+    keep = cc >= drop_tol
+    i, j, cc = i[keep], j[keep], cc[keep]
+    # prior information equations
+    log = pst.parameter_data.loc[names,'partrans'].values == 'log'
+    pnames = np.where(log, 'log(' + names + ')', names)
+    pi_num = pst.prior_information.shape[0] + 1
+    pilbl = ['pcc_{0}'.format(n) for n in range(pi_num, pi_num + len(cc))]
+    df = pd.DataFrame({'pilbl':pilbl, 
+        'equation':'1.0 * ' + pnames[i] + ' - 1.0 * ' + pnames[j] + ' = 0.0',
+        'obgnme':'regul_cc', 'weight':cc}, index=pilbl)
+    if reset:
+        pst.prior_information = df
+    else:
+        pst.prior_information = pd.concat([pst.prior_information, df])
+    if pst.control_data.pestmode == 'estimation':
+        pst.control_data.pestmode = 'regularization'
+    return(df)
+
 def build_jac_test_csv(pst, num_steps, par_names=None, forward=True):
     """build a dataframe of jactest inputs for use with pestpp-swp
 
@@ -183,6 +860,7 @@ def build_jac_test_csv(pst, num_steps, par_names=None, forward=True):
 
     """
     if isinstance(pst, str):
+        import pyemu
         pst = pyemu.Pst(pst)
     # pst.add_transform_columns()
     pst.build_increments()
@@ -3,10 +3,12 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 import os 
+import shutil
 import matplotlib as mpl
 import flopy
 import pyemu
 import helpers
+import swp
 
 # --- pst files 
 opt_dir = 'opt'
@@ -14,6 +16,9 @@ org_pst_name ='opt_50.pst'
 pst_name = 'jactest.pst'
 
 parrep=False
+
+# run sweep with local python workers (swp.py) instead of pestpp-swp
+local_swp=False
 par_file = os.path.join('pst_master',org_pst_name.replace('pst','par'))
 
 # read pest file  
@@ -90,9 +95,17 @@ pst.pestpp_options['sweep_output_csv_file'] = 'jactest_out.csv'
 pst.write(os.path.join(opt_dir,pst_name))
 
 # run
-pyemu.helpers.start_workers(opt_dir,'pestpp-swp',pst_name,num_workers=2,
-                              worker_root= 'workers',cleanup=False,
-                                master_dir='master_swp')
+if local_swp:
+    if not os.path.exists('master_swp'):
+        os.mkdir('master_swp')
+    shutil.copy(os.path.join(opt_dir,'jactest_in.csv'),'master_swp')
+    swp.run_sweep(opt_dir, pst_name, os.path.join(opt_dir,'jactest_in.csv'),
+            os.path.join('master_swp','jactest_out.csv'), num_workers=2,
+            worker_root='workers')
+else:
+    pyemu.helpers.start_workers(opt_dir,'pestpp-swp',pst_name,num_workers=2,
+                                  worker_root= 'workers',cleanup=False,
+                                    master_dir='master_swp')
 
 # plot
 cwd = 'master_swp'
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+
+# read/write of mf6 list (stress period) files, e.g. ext/riv_spd_01_1.txt
+# whitespace-delimited, one boundary per line, layout as written by flopy in setup_ml.py
+
+# column layouts of list files, indexed by package
+list_dtypes = {
+        # [lay, node, q, boundname]
+        'wel':np.dtype([('lay','<i4'),('node','<i4'),('q','<f8'),('boundname','U40')]),
+        # [lay, node, elev, cond, boundname]
+        'drn':np.dtype([('lay','<i4'),('node','<i4'),('elev','<f8'),('cond','<f8'),
+            ('boundname','U40')]),
+        # [lay, node, stage, cond, rbot, fid, boundname]
+        'riv':np.dtype([('lay','<i4'),('node','<i4'),('stage','<f8'),('cond','<f8'),
+            ('rbot','<f8'),('fid','<f8'),('boundname','U40')]),
+        # [lay, node, bhead, cond, boundname]
+        'ghb':np.dtype([('lay','<i4'),('node','<i4'),('bhead','<f8'),('cond','<f8'),
+            ('boundname','U40')]),
+        }
+
+# format of floating point values, fixed precision
+float_fmt = '%.10G'
+
+# infer package of list file from file name (e.g. riv_spd_01_1.txt)
+def get_list_dtype(list_file):
+    pak = os.path.basename(list_file).split('_')[0].lower()
+    if pak not in list_dtypes:
+        raise Exception(f'unknown list file layout for {list_file}')
+    return(list_dtypes[pak])
+
+# read list file into structured array
+# layout is inferred from file name when dtype is not provided
+def read_list(list_file, dtype=None):
+    if dtype is None:
+        dtype = get_list_dtype(list_file)
+    return(np.loadtxt(list_file, dtype=dtype, ndmin=1))
+
+# write structured array to list file
+def write_list(list_file, arr, fmt=None):
+    if fmt is None:
+        fmt = [float_fmt if arr.dtype[name].kind == 'f'
+                else '%d' if arr.dtype[name].kind in 'iu' else '%s'
+                for name in arr.dtype.names]
+    np.savetxt(list_file, arr, fmt=fmt, delimiter=' ')
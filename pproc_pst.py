@@ -3,8 +3,10 @@ import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 import flopy
 import pyemu
+import helpers
 
 # completed PEST run dir - calibrated parameter set
 cal_dir = 'master_glm' 
@@ -19,6 +21,11 @@ store_dir = 'store' # content will be cleared !
 eval_dir = 'pst'  
 eval_pst_name = 'eval.pst'
 
+# pathline plots : particles read by chunks (bounded memory), vertices decimated 
+# by distance (m) along pathlines, None to plot all vertices
+pth_chunk_size = 1000
+pth_min_dist = 5.
+
 # calibration pst file 
 cal_pst = pyemu.Pst(os.path.join(cal_dir, cal_pst_name))
 
@@ -54,10 +61,7 @@ one2one[1].savefig(os.path.join('fig','one2one.png'))
 
 #fetch residuals and add columns from name
 res = eval_pst.res
-res[['type', 'fmt', 'locname', 'time']] = res.name.apply(
-    lambda x: pd.Series(
-        dict([s.split(':') for s in x.split('_') if ':' in s]
-            )))[['oname', 'otype', 'usecol', 'time']]
+res[['type', 'fmt', 'locname', 'time']] = helpers.parse_obsnames(res.name).values
 
 
 # --- plot one2one plot per obs. group 
@@ -120,10 +124,12 @@ for case_dir in case_dirs:
     heads = pmv.plot_array(hds, masked_values=[1.e+30], alpha=0.5)
     cb = plt.colorbar(heads, shrink = 0.5)
 
-    # pathlines for each group
-    pth = flopy.utils.PathlineFile(os.path.join(case_dir,'mp.mppth'))
-    rec = pth.get_alldata()
-    pmv.plot_pathline(rec, layer = 'all', lw = 0.1, alpha = 0.8)
+    # pathlines for each group (not available in endpoint-only mode)
+    pth_file = os.path.join(case_dir,'mp.mppth')
+    if helpers.get_mp_simtype(case_dir) in (2,4):
+        for group, segs in helpers.iter_pathlines(pth_file, chunk_size=pth_chunk_size,
+                min_dist=pth_min_dist, xoff=ml.modelgrid.xoffset, yoff=ml.modelgrid.yoffset):
+            ax.add_collection(LineCollection(segs, colors='0.5', lw = 0.1, alpha = 0.8))
 
     # plot boundaries
     bc_colors_dic = { 'RIV': 'cyan', 'DRN': 'red', 'WEL': 'coral'}
@@ -1,4 +1,7 @@
-import os, sys, shutil
+import os, shutil
+import glob, hashlib, re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import platform
 import numpy as np 
 import pandas as pd
@@ -9,6 +12,7 @@ import flopy
 from flopy.utils.gridgen import Gridgen
 
 from tracktools import ParticleGenerator
+import listio
 
 #-----------------------------------#
 # ----- General settings ----                                                        
@@ -36,6 +40,8 @@ com_ext_dir = os.path.join(ml_dir,'com_ext')
 sim_dir = os.path.join(tpl_ml_dir,'sim')
 ext_dir = os.path.join(tpl_ml_dir,'ext')
 workers_dir = 'workers'
+# persistent cache of grid and intersections (not cleared)
+grd_cache_dir = 'grd_cache'
 dir_list = [tpl_ml_dir, ml_dir, grd_dir, 
         com_ext_dir, sim_dir, ext_dir, workers_dir]
 
@@ -55,11 +61,21 @@ thk = 50 #m
 botm = -20  # m
 h_ghb = 22 # m 
 hstart= 15. # m
+refine_levels = [1,2,3,4,5] # refinement levels of gis/refine/refine_{i}.shp
+# reuse grid and intersections when gis inputs and grid settings are unchanged
+use_grd_cache = True
 
 #  particle tracking settings
 well_shp = os.path.join(gis_dir,'prod_wells.shp')
 drn_shp = os.path.join(gis_dir,'prod_drains.shp')
 n_part = 500
+# endpoint-only tracking (no pathline output), sufficient for mixing ratios
+endpoint_only = False
+# cases other than the first one are written directly from the first case
+# (no flopy load/write), unchanged files are hard-linked
+link_cases = True
+# number of processes writing cases from the first case (requires fork, e.g. linux)
+case_nproc = 1
 
 # prior (initial) parameter values 
 par_df = pd.read_excel(os.path.join(data_dir,'par.xlsx'), index_col = 0)
@@ -79,56 +95,126 @@ xorigin, yorigin = bbox_gdf.MINX[0], bbox_gdf.MINY[0]
 nrow, ncol = [int(round(v/grid_res)) for v in [bbox_gdf.HEIGHT, bbox_gdf.WIDTH ]]
 
 #-----------------------------------#
-#         grid generation                          
+#         grid cache                          
 #-----------------------------------#
-print('Grid generation...')
 
-# --- base model with regular grid 
-# Modflow simulation package
-bsim = flopy.mf6.MFSimulation(sim_name= 'bmfsim', sim_ws = tpl_ml_dir, 
-        exe_name = os.path.join('..',mf6_exe), version='mf6')
-
-# Modflow groundwater flow model 
-bml = flopy.mf6.ModflowGwf(bsim, modelname= 'bml')
-
-# set spatial reference
-bml.modelgrid.set_coord_info(proj4 = proj4, epsg = epsg)
-
-gsdis = flopy.mf6.ModflowGwfdis(bml, length_units='METERS',
-                                      xorigin=xorigin,
-                                      yorigin=yorigin, 
-                                      nlay=nlay,
-                                      nrow=nrow,
-                                      ncol=ncol,
-                                      delr=grid_res,
-                                      delc=grid_res,
-                                      top=top,
-                                      botm=botm)
-
-# ---- Create gridgen object
-
-g = Gridgen(gsdis, exe_name = gridgen_exe,  model_ws = grd_dir)
-
-# ---- set active domain (idomain) for 1st layer 
-g.add_active_domain(os.path.join('..', gis_dir, 'active'),[0])
-
-# ---- set refinement zones 
-for i in range(1,6): 
-    g.add_refinement_features(
-            os.path.join('..',gis_dir,'refine',f'refine_{i}'),
-            'polygon', i, [0])
-
-# ---- Build new grid ----
-g.build(verbose=False)
-
-#---------------------------------------------#
-#    Grid intersections   
-#---------------------------------------------#
-print('Grid intersections...')
+#lists of intersections for all boundaries package settings
+inter_dic = {'active':'polygon',
+        'ghb':'line','prod_drains':'line', 'rivers':'line', 
+        'obs_points':'point', 'wells':'point'}
 
-#  DISV properties
-gridprops = g.get_gridprops_disv()
-node_rec = g.get_nod_recarray()
+# hash of gis inputs (shapefiles) and grid settings 
+def hash_grid_inputs():
+    shp_names = ['bbox'] + list(inter_dic.keys()) + \
+            [os.path.join('refine',f'refine_{i}') for i in refine_levels]
+    h = hashlib.sha1()
+    h.update(repr([grid_res, nlay, top, botm, refine_levels, 
+        sorted(inter_dic.items())]).encode())
+    for shp_name in shp_names:
+        for f in sorted(glob.glob(os.path.join(gis_dir, shp_name + '.*'))):
+            if f.endswith(('.shp','.shx','.dbf','.prj')):
+                h.update(os.path.relpath(f,gis_dir).encode())
+                with open(f,'rb') as fh:
+                    h.update(fh.read())
+    return(h.hexdigest())
+
+# save gridprops, node_rec and intersections to npz
+# ragged cell2d is stored as flat vertex indices and vertex counts
+def save_grid_cache(cache_file, gridprops, node_rec, icpl_dic):
+    verts = np.array([v[1:] for v in gridprops['vertices']], dtype=float)
+    cellxy = np.array([c[1:3] for c in gridprops['cell2d']], dtype=float)
+    ncvert = np.array([c[3] for c in gridprops['cell2d']], dtype=int)
+    iverts = np.concatenate([c[4:] for c in gridprops['cell2d']]).astype(int)
+    arrs = {f'icpl_{k}':np.asarray(v) for k,v in icpl_dic.items()}
+    np.savez_compressed(cache_file, nlay=gridprops['nlay'], ncpl=gridprops['ncpl'],
+            top=gridprops['top'], botm=gridprops['botm'], 
+            verts=verts, cellxy=cellxy, ncvert=ncvert, iverts=iverts,
+            node_rec=np.asarray(node_rec), **arrs)
+
+# load gridprops, node_rec and intersections from npz
+def load_grid_cache(cache_file):
+    with np.load(cache_file) as npz:
+        verts, cellxy = npz['verts'], npz['cellxy']
+        ivert_list = np.split(npz['iverts'], np.cumsum(npz['ncvert'])[:-1])
+        gridprops = {'nlay':int(npz['nlay']), 'ncpl':int(npz['ncpl']),
+                'top':npz['top'], 'botm':npz['botm'], 'nvert':verts.shape[0],
+                'vertices':[[i, x, y] for i, (x, y) in enumerate(verts)],
+                'cell2d':[[n, x, y, len(ivs)] + ivs.tolist() 
+                    for n, ((x, y), ivs) in enumerate(zip(cellxy, ivert_list))]
+                }
+        node_rec = npz['node_rec'].view(np.recarray)
+        icpl_dic = {k:npz[f'icpl_{k}'].view(np.recarray) for k in inter_dic.keys()}
+    return(gridprops, node_rec, icpl_dic)
+
+grd_hash = hash_grid_inputs()
+grd_cache_file = os.path.join(grd_cache_dir, f'grd_{grd_hash}.npz')
+
+if use_grd_cache and os.path.exists(grd_cache_file):
+    print(f'Loading grid and intersections from {grd_cache_file}...')
+    gridprops, node_rec, icpl_dic = load_grid_cache(grd_cache_file)
+else:
+    #-----------------------------------#
+    #         grid generation                          
+    #-----------------------------------#
+    print('Grid generation...')
+
+    # --- base model with regular grid 
+    # Modflow simulation package
+    bsim = flopy.mf6.MFSimulation(sim_name= 'bmfsim', sim_ws = tpl_ml_dir, 
+            exe_name = os.path.join('..',mf6_exe), version='mf6')
+
+    # Modflow groundwater flow model 
+    bml = flopy.mf6.ModflowGwf(bsim, modelname= 'bml')
+
+    # set spatial reference
+    bml.modelgrid.set_coord_info(proj4 = proj4, epsg = epsg)
+
+    gsdis = flopy.mf6.ModflowGwfdis(bml, length_units='METERS',
+                                          xorigin=xorigin,
+                                          yorigin=yorigin, 
+                                          nlay=nlay,
+                                          nrow=nrow,
+                                          ncol=ncol,
+                                          delr=grid_res,
+                                          delc=grid_res,
+                                          top=top,
+                                          botm=botm)
+
+    # ---- Create gridgen object
+
+    g = Gridgen(gsdis, exe_name = gridgen_exe,  model_ws = grd_dir)
+
+    # ---- set active domain (idomain) for 1st layer 
+    g.add_active_domain(os.path.join('..', gis_dir, 'active'),[0])
+
+    # ---- set refinement zones 
+    for i in refine_levels: 
+        g.add_refinement_features(
+                os.path.join('..',gis_dir,'refine',f'refine_{i}'),
+                'polygon', i, [0])
+
+    # ---- Build new grid ----
+    g.build(verbose=False)
+
+    #---------------------------------------------#
+    #    Grid intersections   
+    #---------------------------------------------#
+    print('Grid intersections...')
+
+    #  DISV properties
+    gridprops = g.get_gridprops_disv()
+    node_rec = g.get_nod_recarray()
+
+    icpl_dic = {}
+
+    for inter_id, inter_type in inter_dic.items():
+        shp = os.path.join('..',gis_dir,inter_id)
+        icpl_dic[inter_id] = g.intersect(shp, inter_type, 0)
+
+    # save to cache
+    if not os.path.exists(grd_cache_dir):
+        os.mkdir(grd_cache_dir)
+    save_grid_cache(grd_cache_file, gridprops, node_rec, icpl_dic)
 
 # centroids coordinates
 cx = [cell[1] for cell in gridprops['cell2d']]
@@ -137,17 +223,6 @@ cy = [cell[2] for cell in gridprops['cell2d']]
 #  resolution dictionary
 res_dic = {rec['node']: rec['dx'] for rec in node_rec}
 
-#lists of intersections for all boundaries package settings
-inter_dic = {'active':'polygon',
-        'ghb':'line','prod_drains':'line', 'rivers':'line', 
-        'obs_points':'point', 'wells':'point'}
-
-icpl_dic = {}
-
-for inter_id, inter_type in inter_dic.items():
-    shp = os.path.join('..',gis_dir,inter_id)
-    icpl_dic[inter_id] = g.intersect(shp, inter_type, 0)
-
 # define integer ids for reach names 
 # ids will be used as aux var in the riv package 
 riv_names = [name.decode('utf8') for name in set(icpl_dic['rivers']['fid'])]
@@ -306,7 +381,8 @@ defaultiface6 = {'RCH': 6, 'EVT': 6}
 mpbas = flopy.modpath.Modpath7Bas(mp, porosity=0.1, defaultiface=defaultiface6)
 
 # ---- Build MODPATH7 SIM package
-mpsim = flopy.modpath.Modpath7Sim(mp, simulationtype='pathline',
+mp_simtype = 'endpoint' if endpoint_only else 'pathline'
+mpsim = flopy.modpath.Modpath7Sim(mp, simulationtype=mp_simtype,
                                       trackingdirection='backward',
                                       weaksinkoption='stop_at',
                                       weaksourceoption='stop_at',
@@ -326,13 +402,138 @@ mp.write_input()
 rm_dirs = sorted([d for d in os.listdir(ml_dir) if d.startswith('ml_')])
 for case_dir in rm_dirs: shutil.rmtree(os.path.join(ml_dir,case_dir))
 
+# ---- river cells, for all cases (cases as rows, river cells as columns)
+riv_cells = icpl_dic['rivers']
+riv_nodes = riv_cells['nodenumber']
+riv_cell_names = np.array([name.decode('utf-8') for name in riv_cells['fid']])
+riv_cell_df = riv_df.loc[riv_cell_names]
+# relative position of cell along reach 
+riv_xc = (riv_cells['starting_distance'] + 
+        (riv_cells['starting_distance'] - riv_cells['ending_distance'])/2)/riv_cells['L']
+# bottom elevation at reach ends A and B
+zA = riv_cell_df['A_abs_be'].values - 1.
+zB = riv_cell_df['B_abs_be'].values - 1.
+# conductance (cell size dependent)
+riv_cond = par_df.loc[np.char.add('C_', riv_cell_names),'val'].values * pd.Series(res_dic).loc[riv_nodes].values
+# integer river id as aux var
+riv_fids = np.array([riv_names_dic[riv_name] for riv_name in riv_cell_names])
+# stage at reach ends A and B, relative to h river (H_RIV) of case or absolute
+h_riv = surveys_df.loc[case_ids,'H_RIV'].values[:,None] 
+hA = np.where(riv_cell_df['ref_type_A'].values == 'rel',
+        h_riv + riv_cell_df['relative_A'].values, riv_cell_df['absolute_A'].values)
+hB = np.where(riv_cell_df['ref_type_B'].values == 'rel',
+        h_riv + riv_cell_df['relative_B'].values, riv_cell_df['absolute_B'].values)
+# linear interpolation of stage and bottom (min 0.5m below stage)
+riv_stg = riv_xc * hB + (1 - riv_xc) * hA
+riv_rbot = np.minimum(riv_stg - 0.5, riv_xc * zB + (1 - riv_xc) * zA)
+
+# files written for each case, other files are linked to the reference case
+case_files = ['mfsim.tdis','ml.wel','ml.drn','ml.riv']
+
+# list file formats, as written by flopy
+spd_fmts = {'wel':'  %d %d %.8E %s', 
+        'drn':'  %d %d %.8E %.8E %s', 
+        'riv':'  %d %d %.8E %.8E %.8E %d %s'}
+
+# hard link file, copy when links are not supported (e.g. across devices)
+def link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# convert list file array to flopy stress period data [(lay,node), *values] (0-based)
+# river ids (fid aux var) are passed as integers, as written in list files
+def get_flopy_spd(arr):
+    cols = [(arr[name].astype(int) if name == 'fid' else arr[name]).tolist()
+            for name in arr.dtype.names[2:]]
+    return([[(lay-1, node-1), *vals] for lay, node, *vals in 
+        zip(arr['lay'].tolist(), arr['node'].tolist(), *cols)])
+
+# write case directory from reference case directory, without flopy
+# spd_dic : list file arrays (listio layout) indexed by package
+# only tdis, wel, drn and riv files are written, other files are hard-linked
+# hence linked files must not be modified in place
+def materialize_case(ref_dir, case_dir, ref_id, case_id, spd_dic):
+    for d in ['ext','sim']:
+        os.makedirs(os.path.join(case_dir,d))
+    for f in os.listdir(ref_dir):
+        if os.path.isfile(os.path.join(ref_dir,f)) and f not in case_files:
+            link_file(os.path.join(ref_dir,f), os.path.join(case_dir,f))
+    # initial heads are copied (updated by helpers.run_case with warm_start)
+    shutil.copy(os.path.join(ref_dir,'ext','strt.txt'), os.path.join(case_dir,'ext'))
+    # perlen as case id 
+    with open(os.path.join(ref_dir,'mfsim.tdis')) as f:
+        tdis = f.read()
+    tdis = re.sub(r'(BEGIN perioddata\s*\n)\s*\S+', 
+            r'\g<1>' + f'{float(case_id):17.8f}', tdis)
+    with open(os.path.join(case_dir,'mfsim.tdis'),'w') as f:
+        f.write(tdis)
+    # package files with case stress period data files
+    for pak, spd_data in spd_dic.items():
+        with open(os.path.join(ref_dir,f'ml.{pak}')) as f:
+            pak_txt = f.read()
+        with open(os.path.join(case_dir,f'ml.{pak}'),'w') as f:
+            f.write(pak_txt.replace(f'{pak}_spd_{ref_id:02d}_1.txt',
+                f'{pak}_spd_{case_id:02d}_1.txt'))
+        listio.write_list(os.path.join(case_dir,'ext',f'{pak}_spd_{case_id:02d}_1.txt'),
+                spd_data, fmt=spd_fmts[pak])
+
+drn_ids = [ drn_id.decode('utf8') for drn_id in np.unique(icpl_dic['prod_drains']['fid'])]
+
+# ---- well and drain cells, for all cases
+wel_cells = icpl_dic['wells']
+wel_nodes = wel_cells['nodenumber']
+wel_cell_names = np.char.decode(wel_cells['fid'], 'utf-8')
+drn_cells = icpl_dic['prod_drains']
+drn_nodes = drn_cells['nodenumber']
+drn_cell_names = np.char.decode(drn_cells['fid'], 'utf-8')
+# conductance (cell size dependent)
+drn_cond = par_df.loc[np.char.add('C_', drn_cell_names),'val'].values * pd.Series(res_dic).loc[drn_nodes].values
+
+# wel, drn and riv stress period data of case, as list file arrays (listio layout, 1-based)
+def get_case_spd(icase, case_id):
+    # ---- Well package data [lay, node, q, boundname]
+    wel = np.zeros(len(wel_nodes), dtype=listio.list_dtypes['wel'])
+    wel['lay'], wel['node'] = 1, wel_nodes + 1
+    wel['q'] = surveys_df.loc[case_id, np.char.add('Q_', wel_cell_names)].values*-1./3600. #m3/h to m3/s
+    wel['boundname'] = wel_cell_names
+
+    # ---- Drain package data [lay, node, elev, cond, boundname]
+    drn = np.zeros(len(drn_nodes), dtype=listio.list_dtypes['drn'])
+    drn['lay'], drn['node'] = 1, drn_nodes + 1
+    drn['elev'] = surveys_df.loc[case_id, np.char.add('H_', drn_cell_names)].values
+    drn['cond'] = drn_cond
+    drn['boundname'] = drn_cell_names
+
+    # ---- Riv package data [lay, node, stage, cond, rbot, fid, boundname]
+    riv = np.zeros(len(riv_nodes), dtype=listio.list_dtypes['riv'])
+    riv['lay'], riv['node'] = 1, riv_nodes + 1
+    riv['stage'], riv['cond'], riv['rbot'] = riv_stg[icase], riv_cond, riv_rbot[icase]
+    riv['fid'] = riv_fids
+    riv['boundname'] = riv_cell_names
+
+    return({'wel':wel, 'drn':drn, 'riv':riv})
+
+# write case from reference (first) case
+# run in forked processes with case_nproc > 1, shared inputs are inherited
+def write_case(icase, case_id):
+    case_dir = os.path.join(ml_dir,f'ml_{case_id:02d}')
+    materialize_case(ref_dir, case_dir, case_ids[0], case_id, get_case_spd(icase, case_id))
+    return(case_dir)
+
+# cases written with flopy, all cases when link_cases is False
+flopy_case_ids = case_ids[:1] if link_cases else case_ids
+
 # iterate over cases
-for case_id in case_ids:
+for icase, case_id in enumerate(flopy_case_ids):
 
     print(f'Processing survey {case_id}')
 
     case_dir = os.path.join(ml_dir,f'ml_{case_id:02d}')
-    
+    case_spd = get_case_spd(icase, case_id)
+    wells_data, drn_data, riv_data = [get_flopy_spd(case_spd[pak]) for pak in ['wel','drn','riv']]
+
     shutil.copytree(tpl_ml_dir,case_dir)
     
     # load base simulation 
@@ -352,17 +553,11 @@ for case_id in case_ids:
     ml.npf.k.store_as_external_file(os.path.join('..','com_ext','k.txt'))
     ml.ghb.stress_period_data.store_as_external_file(os.path.join('..','com_ext','ghb_spd.txt'))
     ml.rcha.recharge.store_as_external_file(os.path.join('..','com_ext','rech_spd.txt'))
+    # case-specific initial heads (updated by helpers.run_case with warm_start)
+    ml.ic.strt.store_as_external_file(os.path.join('ext','strt.txt'))
  
     # ---- Well package
     print('ModflowGwfwel...')
-    wells_data = []
-    for well_cell in icpl_dic['wells']:
-        node = well_cell['nodenumber']
-        well_id = well_cell['fid'].decode('utf-8')
-        well_Q = surveys_df.loc[case_id,'Q_'+well_id]*-1./3600. #m3/h to m3/s
-        # [cellid, q, boundname]
-        wells_data.append([(0,node),well_Q,well_id])
-
     wel = flopy.mf6.ModflowGwfwel(ml, save_flows = True,
                                      stress_period_data = wells_data,        
                                      maxbound=len(wells_data),
@@ -372,17 +567,6 @@ for case_id in case_ids:
 
     # ---- Drain package
     print('ModflowGwfdrn...')
-
-    drn_data = []
-    for drn_cell in icpl_dic['prod_drains']:
-        node = drn_cell['nodenumber']
-        drn_id = drn_cell['fid'].decode('utf-8')
-        drn_h = surveys_df.loc[case_id,f'H_{drn_id}']
-        drn_cond = par_df.loc['C_'+drn_id,'val'] * res_dic[node]
-        # [cellid, elev, cond, boundname]
-        drn_data.append([(0,node), drn_h, drn_cond, drn_id])
-
-    drn_ids = [ drn_id.decode('utf8') for drn_id in np.unique(icpl_dic['prod_drains']['fid'])]
     drn_obs = {os.path.join('sim','drn.csv'): [(drn_id, 'DRN',drn_id) for drn_id in drn_ids]}
 
     drn = flopy.mf6.ModflowGwfdrn(ml, save_flows = True,
@@ -395,35 +579,6 @@ for case_id in case_ids:
 
     # ---- Riv package
     print('ModflowGwfriv...')
-
-    h_riv = surveys_df.loc[case_id,'H_RIV'] # Fetch h river (m)
-    riv_data = []
-    # ---- iterate over each reach
-    for stream_cell in icpl_dic['rivers']:
-        node = stream_cell['nodenumber']
-        riv_name = stream_cell['fid'].decode('utf-8')
-        zA, zB = riv_df.loc[riv_name,['A_abs_be','B_abs_be']] - 1. # zbot 
-        xstart, xend= stream_cell['starting_distance'], stream_cell['ending_distance']
-        L = stream_cell['L']
-        xc = (xstart + (xstart - xend)/2)/L 
-        if riv_df.loc[riv_name,'ref_type_A'] == 'rel':               
-            hA = h_riv + riv_df.loc[riv_name,'relative_A']
-        else :
-            hA = riv_df.loc[riv_name,'absolute_A']
-        if riv_df.loc[riv_name,'ref_type_B'] == 'rel':              
-            hB = h_riv + riv_df.loc[riv_name,'relative_B']
-        else :
-            hB = riv_df.loc[riv_name,'absolute_B']
-        # linear interpolation
-        riv_stg = xc * hB + (1 - xc) * hA # stage                             
-        z_bot = min(riv_stg-0.5, xc * zB + (1 - xc) * zA) # bottom (min 0.5m below stage)
-        # conductivity (cell size dependent)
-        riv_cond = par_df.loc['C_'+riv_name,'val'] * res_dic[node] 
-        # integer river id as aux var
-        riv_id = riv_names_dic[riv_name]
-        # [cellid, stage, cond, rbot, aux, boundname]
-        riv_data.append([(0,node), riv_stg, riv_cond, z_bot,riv_id, riv_name])
-
     riv = flopy.mf6.ModflowGwfriv(ml,auxiliary=['fid'], save_flows = True,
                                              stress_period_data = riv_data,        
                                              maxbound = len(riv_data),
@@ -435,11 +590,20 @@ for case_id in case_ids:
     print('Writing model...')
     csim.write_simulation()
 
+# ---- other cases, from reference case 
+ref_dir = os.path.join(ml_dir,f'ml_{case_ids[0]:02d}')
+link_case_ids = case_ids[len(flopy_case_ids):]
+print(f'Writing {len(link_case_ids)} case(s) from reference case...')
+if case_nproc > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    with ProcessPoolExecutor(max_workers=case_nproc, mp_context=multiprocessing.get_context('fork')) as pool:
+        for case_dir in pool.map(write_case, range(len(flopy_case_ids),len(case_ids)), link_case_ids):
+            print(f'{case_dir} written')
+else:
+    for icase, case_id in enumerate(link_case_ids, len(flopy_case_ids)):
+        write_case(icase, case_id)
 
 # -- initial forward run 
-os.chdir(ml_dir)
-sys.path.append('.')
 import helpers
-helpers.run_cases()
+helpers.run_cases(ml_dir)
 
 
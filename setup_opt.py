@@ -4,6 +4,7 @@ import numpy as np
 import flopy
 import pyemu
 import helpers
+import listio
 
 # optimization under uncertainty
 uu = False
@@ -27,6 +28,13 @@ sim_dir = 'ml_99'
 # mf6 exe
 mf6_exe = 'mf6'
 
+# number of cases run in parallel by each worker (uu only)
+case_nproc = 1
+
+# forward runs served by a resident python process per worker dir (see fwd_daemon.py)
+# unix only, False : new interpreter for each run
+use_fwd_daemon = False
+
 # parameter data (prior confidence interval) 
 par_df = pd.read_excel(os.path.join(data_dir,'par.xlsx'), index_col = 0)
 
@@ -49,45 +57,30 @@ sr = {i:(x,y) for i,x,y in zip(range(ncpl),
 # get template drn ext file (with calibrated cond values)
 case_id=2
 tpl_drn_file = os.path.join(cal_dir,'ml_02','ext',f'drn_spd_{case_id:02d}_1.txt')
-tpl_drn_df = pd.read_csv(tpl_drn_file,delim_whitespace=True, header=None)
+tpl_drn = listio.read_list(tpl_drn_file)
 
 # fetch parameter from drn ext file (with simulation stage values)
 case_id=99
 sim_drn_file = os.path.join(cal_dir,sim_dir,'ext',f'drn_spd_{case_id:02d}_1.txt')
-sim_drn_df = pd.read_csv(sim_drn_file,delim_whitespace=True, header=None)
-sim_drn_df.iloc[:,3]=tpl_drn_df.iloc[:,3]
-
-# write sim df with updated parameter values
-with open(sim_drn_file, 'w') as f:
-        f.write(
-            sim_drn_df.to_string(
-                header=False,
-                index=False,
-            )
-            + '\n'
-        )
+sim_drn = listio.read_list(sim_drn_file)
+sim_drn['cond'] = tpl_drn['cond']
 
+# write sim file with updated parameter values
+listio.write_list(sim_drn_file, sim_drn)
 
 # get template riv ext file (with calibrated cond values)
 case_id=2
 tpl_riv_file = os.path.join(cal_dir,'ml_02','ext',f'riv_spd_{case_id:02d}_1.txt')
-tpl_riv_df = pd.read_csv(tpl_riv_file,delim_whitespace=True, header=None)
+tpl_riv = listio.read_list(tpl_riv_file)
 
 # fetch parameter from riv ext file (with simulation stage values)
 case_id=99
 sim_riv_file = os.path.join(cal_dir,sim_dir,'ext',f'riv_spd_{case_id:02d}_1.txt')
-sim_riv_df = pd.read_csv(sim_riv_file,delim_whitespace=True, header=None)
-sim_riv_df.iloc[:,3]=tpl_riv_df.iloc[:,3]
-
-# write sim df with updated parameter values
-with open(sim_riv_file, 'w') as f:
-        f.write(
-            sim_riv_df.to_string(
-                header=False,
-                index=False,
-            )
-            + '\n'
-        )
+sim_riv = listio.read_list(sim_riv_file)
+sim_riv['cond'] = tpl_riv['cond']
+
+# write sim file with updated parameter values
+listio.write_list(sim_riv_file, sim_riv)
 
 helpers.run_case(os.path.join(cal_dir,sim_dir))
 
@@ -291,20 +284,23 @@ forecasts = sim_mr_df.index.to_list() + sim_q_df.index.to_list() + glob_df.index
 # -------------------------------------------------------
 
 # functions for forward_run.py
+# helpers is shipped with the opt dir and imported by forward_run.py
+for py_module in ['helpers.py', 'listio.py', 'fwd_daemon.py']:
+    shutil.copy(py_module, pf.new_d)
+pf.extra_py_imports.append('helpers')
 if uu:
-    pf.add_py_function('helpers.py','run_cases()',is_pre_cmd=False)
+    pf.post_py_cmds.append(f'helpers.run_cases(nproc={case_nproc})')
 else : 
-    pf.add_py_function('helpers.py','run_sim()',is_pre_cmd=False)
-
-pf.add_py_function('helpers.py','run_case()',is_pre_cmd=None)
-pf.add_py_function('helpers.py','ptrack_pproc()',is_pre_cmd=None)
-pf.add_py_function('helpers.py','compute_glob()',is_pre_cmd=None)
+    pf.post_py_cmds.append('helpers.run_sim()')
 
 # ---- Build Pst  
 pst = pf.build_pst()
 
 # replace python by python3
-pst.model_command = ['python3 forward_run.py'] 
+if use_fwd_daemon:
+    pst.model_command = ['python3 fwd_daemon.py'] 
+else:
+    pst.model_command = ['python3 forward_run.py'] 
 
 # run manager options 
 pst.pestpp_options['overdue_resched_fac'] = 2
@@ -319,26 +315,9 @@ if uu:
     par.loc[ppo_idx[1:],'partrans'] = 'tied'
     par.loc[ppo_idx[1:],'partied'] = ppo_idx[0]
 
-    # tie riv and drn conds to 1st case (inst)
-    par['inst']=par.inst.astype(int)
-    ninst = len(par.loc[par.pargp=='criv','inst'].unique())
-
-    riv_inst0_idx = par.loc[(par.pargp=='criv') & (par.inst == 0)].index
-    riv_tied_idx = par.loc[(par.pargp=='criv') & (par.inst > 0)].index
-
-    drn_inst0_idx = par.loc[(par.pargp=='cdrn') & (par.inst == 0)].index
-    drn_tied_idx = par.loc[(par.pargp=='cdrn') & (par.inst > 0)].index
-
-    par.loc[riv_tied_idx,'partrans'] = 'tied'
-    par.loc[drn_tied_idx,'partrans'] = 'tied'
-
-    for i in range(1,ninst):
-        # tie criv
-        idx = par.loc[(par.pargp=='criv') & (par.inst == i)].index
-        par.loc[idx,'partied'] = riv_inst0_idx.values
-        # tie cdrn
-        idx = par.loc[(par.pargp=='cdrn') & (par.inst == i)].index
-        par.loc[idx,'partied'] = drn_inst0_idx.values
+    # tie riv and drn conds to 1st case (inst), matched by reach/drain name
+    for pargp in ['criv','cdrn']:
+        helpers.tie_pars(par, pargp)
 
 # ---- Observation processing  
 obs = pst.observation_data
@@ -348,17 +327,14 @@ if uu:
     surveys_df = pd.read_excel(os.path.join(data_dir,'surveys.xlsx'), index_col = 0)
 
     # extract obs type and loc from (long) name
-    obs[['prefix','type','loc','time']] = obs.obsnme.apply(
-        lambda x: pd.Series(
-            dict([s.split(':') for s in x.split('_') if ':' in s])))
+    obs[['prefix','type','loc','time']] = helpers.parse_obsnames(obs.obsnme).values
 
     # get ob id and case
-    obs['id'] = obs[['prefix', 'loc']].agg('_'.join, axis=1).str.upper()
+    obs['id'] = (obs['prefix'] + '_' + obs['loc']).str.upper()
     obs['case'] = obs['time'].astype(float).astype(int)
 
     # set obs values from surveys df
-    obs['obsval'] = [surveys_df.loc[case_id,obs_id]
-            for case_id,obs_id in zip(obs.case,obs.id)]
+    obs['obsval'] = helpers.get_obsvals(surveys_df, obs.case, obs.id)
 
     # convert discharge rates from m3/h to m3/s
     obs.loc[obs.obgnme == 'qdrn','obsval'] = obs.loc[obs.obgnme == 'qdrn','obsval']*(-1./3600)
@@ -369,9 +345,9 @@ if uu:
     # adjusting weights from measurement error 
     weights_df = pd.read_excel(os.path.join(data_dir,'weights.xlsx'), index_col = 0)
 
-    for obgnme in ['heads','qdrn','mr']:
-        # weighting based on measurement error 
-        obs.loc[obs.obgnme==obgnme,'weight'] = 1./weights_df.loc[obgnme,'sigma']
+    # weighting based on measurement error 
+    wobs = obs.obgnme.isin(['heads','qdrn','mr'])
+    obs.loc[wobs,'weight'] = helpers.get_obs_weights(weights_df, obs.loc[wobs,'obgnme'], use_factor=False)
 
     # 0-weight to unavailable obs
     obs.loc[obs.obsval.isna(),['weight','obsval']]=0
@@ -1,8 +1,9 @@
-import os, sys
+import os, sys, shutil
 import pandas as pd
 import numpy as np
 import flopy
 import pyemu
+import helpers
 
 mf6_exe = 'mf6'
 
@@ -15,6 +16,36 @@ pst_dir = 'pst'
 
 pst_name_suffix = ''
 
+# number of cases run in parallel by each worker 
+case_nproc = 1
+
+# skip cases with unchanged inputs since their last run (see helpers.run_case)
+case_incremental = False
+
+# seed mf6 initial heads from the last converged run of each case
+case_warm_start = False
+
+# per-stage timings of each case appended to this file (json lines), None to disable
+case_log_file = None
+
+# scratch root for model outputs of each case (e.g. '/dev/shm'), None to write in worker dirs
+# only sim/*.csv files (instruction file targets) are copied back to worker dirs
+case_scratch_root = None
+
+# control file in pest++ version 2 format : all sections, incl. prior information
+# (pilot point regularization), written to external csv files (e.g. cal.pi_data.csv)
+# False : version 1 format, prior information equations embedded in the control file
+pst_external = False
+
+# immutable model files hard-linked across worker dirs (see helpers.provision_worker)
+# linked files must never be edited in worker dirs
+# False : full copies with pyemu.helpers.start_workers()
+share_worker_files = False
+
+# forward runs served by a resident python process per worker dir (see fwd_daemon.py)
+# unix only, False : new interpreter for each run
+use_fwd_daemon = False
+
 # set path, relative to ml dir
 com_ext_dir = 'com_ext'
 
@@ -135,16 +166,24 @@ for case_dir in case_dirs:
     mr_df = pf.add_observations(mr_filename, insfile=mr_filename+'.ins',
             index_cols=0, prefix='mr',obsgp = 'mr')
 
-pf.add_py_function('helpers.py','run_cases()',is_pre_cmd=False)
-pf.add_py_function('helpers.py','run_case()',is_pre_cmd=None)
-pf.add_py_function('helpers.py','ptrack_pproc()',is_pre_cmd=None)
-pf.add_py_function('helpers.py','compute_glob()',is_pre_cmd=None)
+# forward run : helpers is shipped with the pst dir and imported by forward_run.py
+for py_module in ['helpers.py', 'listio.py', 'fwd_daemon.py']:
+    shutil.copy(py_module, pf.new_d)
+pf.extra_py_imports.append('helpers')
+run_kwargs = {'nproc':case_nproc, 'incremental':case_incremental, 
+        'warm_start':case_warm_start, 'log_file':case_log_file,
+        'scratch_root':case_scratch_root}
+pf.post_py_cmds.append('helpers.run_cases({0})'.format(
+    ', '.join([f'{k}={v!r}' for k,v in run_kwargs.items()])))
 
 # ---- Build Pst  
 pst = pf.build_pst()
 
 # replace python by python3
-pst.model_command = ['python3 forward_run.py'] 
+if use_fwd_daemon:
+    pst.model_command = ['python3 fwd_daemon.py'] 
+else:
+    pst.model_command = ['python3 forward_run.py'] 
 
 # --- parameter processing
 par = pst.parameter_data 
@@ -153,26 +192,9 @@ par = pst.parameter_data
 par.loc[ppo_idx[1:],'partrans'] = 'tied'
 par.loc[ppo_idx[1:],'partied'] = ppo_idx[0]
 
-# tie riv and drn conds to 1st case (inst)
-par['inst']=par.inst.astype(int)
-ninst = len(par.loc[par.pargp=='criv','inst'].unique())
-
-riv_inst0_idx = par.loc[(par.pargp=='criv') & (par.inst == 0)].index
-riv_tied_idx = par.loc[(par.pargp=='criv') & (par.inst > 0)].index
-
-drn_inst0_idx = par.loc[(par.pargp=='cdrn') & (par.inst == 0)].index
-drn_tied_idx = par.loc[(par.pargp=='cdrn') & (par.inst > 0)].index
-
-par.loc[riv_tied_idx,'partrans'] = 'tied'
-par.loc[drn_tied_idx,'partrans'] = 'tied'
-
-for i in range(1,ninst):
-    # tie criv
-    idx = par.loc[(par.pargp=='criv') & (par.inst == i)].index
-    par.loc[idx,'partied'] = riv_inst0_idx.values
-    # tie cdrn
-    idx = par.loc[(par.pargp=='cdrn') & (par.inst == i)].index
-    par.loc[idx,'partied'] = drn_inst0_idx.values
+# tie riv and drn conds to 1st case (inst), matched by reach/drain name
+for pargp in ['criv','cdrn']:
+    helpers.tie_pars(par, pargp)
 
 
 # ---- observation processing  
@@ -182,17 +204,14 @@ obs = pst.observation_data
 surveys_df = pd.read_excel(os.path.join(data_dir,'surveys.xlsx'), index_col = 0)
 
 # extract obs type and loc from (long) name
-obs[['prefix','type','loc','time']] = obs.obsnme.apply(
-    lambda x: pd.Series(
-        dict([s.split(':') for s in x.split('_') if ':' in s])))
+obs[['prefix','type','loc','time']] = helpers.parse_obsnames(obs.obsnme).values
 
 # get ob id and case
-obs['id'] = obs[['prefix', 'loc']].agg('_'.join, axis=1).str.upper()
+obs['id'] = (obs['prefix'] + '_' + obs['loc']).str.upper()
 obs['case'] = obs['time'].astype(float).astype(int)
 
 # set obs values from surveys df
-obs['obsval'] = [surveys_df.loc[case_id,obs_id]
-        for case_id,obs_id in zip(obs.case,obs.id)]
+obs['obsval'] = helpers.get_obsvals(surveys_df, obs.case, obs.id)
 
 # convert discharge rates from m3/h to m3/s
 obs.loc[obs.obgnme == 'qdrn','obsval'] = obs.loc[obs.obgnme == 'qdrn','obsval']*(-1./3600)
@@ -204,30 +223,24 @@ obs.loc[obs.obgnme == 'mr','obsval'] = obs.loc[obs.obgnme == 'mr','obsval']/100.
 # adjusting weights from measurement error 
 weights_df = pd.read_excel(os.path.join(data_dir,'weights.xlsx'), index_col = 0)
 
-for obgnme in obs.obgnme.unique():
-    # weighting based on measurement error 
-    obs.loc[obs.obgnme==obgnme,'weight'] = 1./weights_df.loc[obgnme,'sigma']
-    # magnifying tuning factor 
-    obs.loc[obs.obgnme==obgnme,'weight'] = obs.loc[obs.obgnme==obgnme,'weight']*weights_df.loc[obgnme,'factor']
-
+# weighting based on measurement error, magnified by tuning factor
+obs['weight'] = helpers.get_obs_weights(weights_df, obs.obgnme)
 
 # 0-weight to unavailable obs
 obs.loc[obs.obsval.isna(),['weight','obsval']]=0
 
 # phimlim =  nobs*tuning_factor
-phimlim = np.array(
-        [ weights_df.loc[obgnme,'factor']*(obs.obgnme==obgnme).sum() 
-    for obgnme in obs.obgnme.unique()]
-    ).sum()
+phimlim = weights_df.loc[obs.obgnme.values,'factor'].sum()
 
 
 #=================
 
 # Tikhonov reg 
 pyemu.helpers.zero_order_tikhonov(pst)
-cov_mat = grid_gs.covariance_matrix(pp_df.x,pp_df.y,pp_df.parnme)
-# mind that no warning is generated when names in cov_mat do not match names in pst
-pyemu.helpers.first_order_pearson_tikhonov(pst,cov_mat,reset=False,abs_drop_tol=0.2)
+# first order pearson from pp neighbours within correlation range (no dense covariance matrix)
+# mind that no warning is generated when pp names do not match names in pst
+helpers.sparse_pearson_tikhonov(pst, grid_gs, pp_df.x, pp_df.y, pp_df.parnme,
+        drop_tol=0.2, reset=False)
 
 # regularization settings
 pst.reg_data.phimlim = phimlim*1.5
@@ -257,16 +270,21 @@ pst.parameter_groups.loc['hk',"derinc"] = 0.15
 
 # ---- write pst   
 pst_name = f'cal{pst_name_suffix}.pst' 
-pst.write(os.path.join(pf.new_d,pst_name ))
+pst.write(os.path.join(pf.new_d,pst_name ), version=2 if pst_external else 1)
 
 # ---- run  pst with noptmax=0
 #pyemu.helpers.run(f'pestpp-glm {pst_name}', cwd=pf.new_d)
 
 # write pst with noptmax =30
 pst.control_data.noptmax=30
-pst.write(os.path.join(pf.new_d, pst_name))
+pst.write(os.path.join(pf.new_d, pst_name), version=2 if pst_external else 1)
 
 # start workers
-pyemu.helpers.start_workers("pst",'pestpp-glm',pst_name,num_workers=64,
+if share_worker_files:
+    helpers.start_linked_workers("pst",'pestpp-glm',pst_name,num_workers=64,
+                              worker_root= 'workers',cleanup=False,
+                                master_dir='master_glm')
+else:
+    pyemu.helpers.start_workers("pst",'pestpp-glm',pst_name,num_workers=64,
                               worker_root= 'workers',cleanup=False,
                                 master_dir='master_glm')
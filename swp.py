@@ -0,0 +1,165 @@
+import os, sys, shutil
+import argparse
+import asyncio
+import json
+import runpy
+import time
+import traceback
+import numpy as np
+import pandas as pd
+
+# local parameter sweep (e.g. jactest) without pestpp-swp
+# runs of a sweep csv file are dispatched by asyncio to persistent python workers,
+# one per worker dir. Workers import pyemu, helpers and tracktools once, then
+# run forward_run.py in-process for each run.
+# output csv has the layout of pestpp-swp (sweep_output_csv_file)
+
+#-----------------------------------#
+#    worker side
+#-----------------------------------#
+
+# parameter values of all parameters (incl. tied) for run values of sweep csv
+# tied parameters follow their parent with the ratio of initial values
+def get_run_parvals(par, run_pars):
+    parvals = par.parval1.copy()
+    parvals.update(pd.Series(run_pars, dtype=float))
+    tied = par.index[par.partrans == 'tied']
+    if len(tied) > 0:
+        parents = par.loc[tied,'partied'].values
+        ratios = par.loc[tied,'parval1'].values / par.loc[parents,'parval1'].values
+        parvals.loc[tied] = parvals.loc[parents].values * ratios
+    return(parvals*par.scale + par.offset)
+
+# persistent worker, run from worker dir
+# reads runs (json lines) from stdin, replies with simulated values (json lines)
+# stdout of forward runs (incl. model sub-processes) is redirected to stderr
+def run_worker(pst_name):
+    # modules shipped with the worker dir first, as for forward_run.py
+    sys.path.insert(0, os.getcwd())
+    import pyemu
+    import helpers
+    try:
+        import tracktools
+    except ImportError:
+        pass
+    # keep stdout for replies only
+    reply = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    pst = pyemu.Pst(pst_name)
+    par = pst.parameter_data
+    par.index = par.index.str.lower()
+    par['partied'] = par.partied.astype(str).str.lower()
+    for line in sys.stdin:
+        run = json.loads(line)
+        t0 = time.perf_counter()
+        try:
+            parvals = get_run_parvals(par, run['pars'])
+            parnames = parvals.index.values.astype(str)
+            for tpl_file, in_file in zip(pst.template_files, pst.input_files):
+                tpl = helpers.compile_tpl(tpl_file, keep_commas=True)
+                helpers.write_tpl(tpl, parnames, parvals.values, in_file)
+            runpy.run_path('forward_run.py', run_name='__main__')
+            obs = pd.concat([pyemu.pst_utils.InstructionFile(ins, pst=pst).read_output_file(out)
+                for ins, out in zip(pst.instruction_files, pst.output_files)])
+            out = {'run_id':run['run_id'], 'failed':False, 'obs':obs.obsval.to_dict()}
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            out = {'run_id':run['run_id'], 'failed':True, 'error':repr(e)}
+        out['time'] = time.perf_counter()-t0
+        reply.write(json.dumps(out) + '\n')
+        reply.flush()
+
+#-----------------------------------#
+#    manager side
+#-----------------------------------#
+
+# start worker process in worker dir and process runs from queue
+async def serve_runs(worker_dir, pst_name, queue, results):
+    proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--worker', pst_name,
+            cwd=worker_dir, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=2**26)
+    while not queue.empty():
+        run_id, pars = queue.get_nowait()
+        proc.stdin.write((json.dumps({'run_id':run_id, 'pars':pars}) + '\n').encode())
+        await proc.stdin.drain()
+        line = await proc.stdout.readline()
+        if len(line) == 0:
+            # worker died, run reported as failed
+            results[run_id] = {'run_id':run_id, 'failed':True, 'error':'worker exited'}
+            break
+        results[run_id] = json.loads(line)
+        print('{0} : run {1} done in {2:.1f}s'.format(worker_dir, run_id, results[run_id]['time']))
+    proc.stdin.close()
+    await proc.wait()
+
+# dispatch runs of sweep dataframe to workers
+async def dispatch(worker_dirs, pst_name, in_df):
+    queue = asyncio.Queue()
+    for run_id, row in in_df.iterrows():
+        queue.put_nowait((run_id, row.dropna().to_dict()))
+    results = {}
+    await asyncio.gather(*[serve_runs(d, pst_name, queue, results) for d in worker_dirs])
+    return(results)
+
+# sweep output dataframe, with the layout of pestpp-swp output csv
+# run_id, input_run_id, failed_flag, phi, meas_phi, regul_phi, phi of obs groups, obs values
+def get_swp_out_df(pst, in_df, results):
+    obs = pst.observation_data
+    obs_df = pd.DataFrame([results.get(run_id,{}).get('obs',{}) for run_id in in_df.index],
+            columns=obs.index.str.lower()).astype(float)
+    obs_df.columns = obs.index
+    res2 = ((obs_df - obs.obsval) * obs.weight)**2
+    grp_phi = res2.T.groupby(obs.obgnme).sum(min_count=1).T.reset_index(drop=True)
+    grp_phi.columns.name = None
+    regul = grp_phi.columns.str.startswith('regul')
+    out_df = pd.DataFrame({'run_id':np.arange(len(in_df)),
+        'input_run_id':in_df.index.values,
+        'failed_flag':[int(results.get(run_id,{}).get('failed',True)) for run_id in in_df.index],
+        'phi':grp_phi.sum(axis=1, min_count=1).values,
+        'meas_phi':grp_phi.loc[:,~regul].sum(axis=1, min_count=1).values,
+        'regul_phi':grp_phi.loc[:,regul].sum(axis=1).values})
+    out_df = pd.concat([out_df, grp_phi, obs_df.reset_index(drop=True)], axis=1)
+    return(out_df)
+
+# run parameter sweep of in_csv (runs as rows, parameters as columns) in local workers
+# worker dirs are provisioned from template_dir (see helpers.provision_worker)
+# parameters missing from in_csv keep their pst values
+def run_sweep(template_dir, pst_name, in_csv, out_csv, num_workers=2, worker_root='workers'):
+    import pyemu
+    import helpers
+    pst = pyemu.Pst(os.path.join(template_dir, pst_name))
+    in_df = pd.read_csv(in_csv, index_col=0)
+    in_df.columns = in_df.columns.str.lower()
+    worker_dirs = []
+    for i in range(min(num_workers, len(in_df))):
+        worker_dir = os.path.join(worker_root, f'worker_{i}')
+        if os.path.exists(worker_dir):
+            shutil.rmtree(worker_dir)
+        helpers.provision_worker(template_dir, worker_dir)
+        worker_dirs.append(worker_dir)
+    results = asyncio.run(dispatch(worker_dirs, pst_name, in_df))
+    out_df = get_swp_out_df(pst, in_df, results)
+    out_df.to_csv(out_csv, index=False)
+    failed = out_df.input_run_id[out_df.failed_flag == 1].astype(str).to_list()
+    if len(failed) > 0:
+        print('run_sweep() : {0} failed run(s) : {1}'.format(len(failed), ', '.join(failed)))
+    return(out_df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local parameter sweep')
+    parser.add_argument('--worker', metavar='PST', help='run as worker (internal)')
+    parser.add_argument('--template', default='.', help='template dir (pst dir)')
+    parser.add_argument('--pst', help='pst file name, in template dir')
+    parser.add_argument('--in-csv', help='sweep input csv file')
+    parser.add_argument('--out-csv', default='sweep_out.csv', help='sweep output csv file')
+    parser.add_argument('--nworkers', type=int, default=2, help='number of workers')
+    parser.add_argument('--worker-root', default='workers', help='root of worker dirs')
+    args = parser.parse_args()
+    if args.worker is not None:
+        run_worker(args.worker)
+    else:
+        run_sweep(args.template, args.pst, args.in_csv, args.out_csv,
+                num_workers=args.nworkers, worker_root=args.worker_root)